@@ -0,0 +1,100 @@
+import os
+import numpy as np
+
+class AccumulationStore():
+    def __init__(self, n_members, times, shape, dtype=np.float64):
+        """Running total of precipitation since the start of the forecast for every
+        member and forecast hour. Accumulation over any window that lines up with the
+        forecast hours comes from a single subtraction.
+
+        Parameters
+        ----------
+        n_members : int
+            Number of ensemble members
+        times : np.array
+            Forecast hours, starting at 0
+        shape : tuple
+            (M, N) shape of each field
+        dtype : np.dtype
+            Storage type. Default = np.float64
+        """
+        self.times = np.asarray(times)
+        self.hour_idx = {int(hour): i for i, hour in enumerate(self.times)}
+        self.total = np.zeros((n_members, self.times.shape[0]) + tuple(shape), dtype=dtype)
+
+    def add(self, t, apcp, start_hours):
+        """Add a forecast hour of bucket precipitation to the running totals.
+
+        Parameters
+        ----------
+        t : int
+            Index into times of the end of the bucket
+        apcp : np.array
+            Precipitation accumulated over each member's bucket (PxMxN)
+        start_hours : list
+            Forecast hour each member's bucket starts at, from the GRIB time-range
+            metadata. Must be one of the forecast hours already added.
+        """
+        for member, start in enumerate(start_hours):
+            self.total[member, t] = self.total[member, self.hour_idx[int(start)]] + \
+                                    apcp[member]
+
+    def window(self, t, hours):
+        """Precipitation accumulated over the given number of hours ending at a forecast
+        hour. Windows that reach back past the start of the forecast return the total
+        since F000.
+
+        Parameters
+        ----------
+        t : int
+            Index into times of the end of the window
+        hours : int
+            Length of the window (hours)
+
+        Returns
+        -------
+        accum : np.array
+            Accumulated precipitation for every member (PxMxN)
+        """
+        start = int(self.times[t]) - hours
+        if start <= self.times[0]:
+            return self.total[:, t] - self.total[:, 0]
+        return self.total[:, t] - self.total[:, self.hour_idx[start]]
+
+    def save(self, t, fname):
+        """Save the running totals at one forecast hour, at full precision, so a later
+        run can resume from them.
+
+        Parameters
+        ----------
+        t : int
+            Index into times
+        fname : str
+            Output file (.npy)
+        """
+        tmp_name = fname[:-4] + '.tmp.npy'
+        np.save(tmp_name, self.total[:, t])
+        os.replace(tmp_name, fname)
+
+    def load(self, t, fname):
+        """Restore the running totals at one forecast hour from save().
+
+        Parameters
+        ----------
+        t : int
+            Index into times
+        fname : str
+            File written by save()
+
+        Returns
+        -------
+        bool
+            False if fname is missing, unreadable or for a different grid
+        """
+        try:
+            total = np.load(fname)
+        except (OSError, ValueError):
+            return False
+        if total.shape != self.total.shape[:1] + self.total.shape[2:]: return False
+        self.total[:, t] = total
+        return True
@@ -1,11 +1,20 @@
 import dash
-import dash_core_components as dcc
-import dash_html_components as html
+from dash import dcc, html
 import dash_leaflet as dl
 import dash_leaflet.express as dlx
 import json
 from plotconfigs import *
-from dash.dependencies import Output, Input
+from mapinfo import domains
+import tiles
+import precompress
+from productcache import ProductCache, Prefetcher
+from manifest import ManifestIndex
+from membercube import CUBE_VARIABLES
+from pointquery import PlumeReader
+import boundaries
+from dash.dependencies import Output, Input, State, ClientsideFunction
+from dash.exceptions import PreventUpdate
+from flask import Response, abort, jsonify, request
 
 import matplotlib
 from datetime import datetime, timedelta, date
@@ -18,46 +27,80 @@ parameters = {
     '6-hr precipitation': 'qpf_06h',
     '12-hr precipitation': 'qpf_12h',
     'Total snow depth': 'snod_total',
+    '10-m wind gust': 'gust10m',
 }
 
 variable_types = {
     'LPMM': 'lpmm',
     'Max': 'max',
+    'Min': 'min',
+    '10th percentile': 'p10',
+    '25th percentile': 'p25',
+    'Median': 'p50',
+    '75th percentile': 'p75',
+    '90th percentile': 'p90',
+    'Probability': 'prob',
     'Spaghetti': 'sp'
 }
 
+# Variable types with one product per threshold
+threshold_types = ['prob', 'sp']
+
+# Variable types create_geojson.py writes for each parameter
+parameter_types = {
+    'qpf_03h': list(variable_types.values()),
+    'qpf_06h': list(variable_types.values()),
+    'qpf_12h': list(variable_types.values()),
+    'snod_total': [v for v in variable_types.values() if v != 'sp'],
+    'gust10m': ['lpmm', 'max', 'prob'],
+}
+
 thresholds = {
     '3-hr precipitation': [0.10, 0.25, 0.50],
     '6-hr precipitation': [0.10, 0.25, 0.50],
     '12-hr precipitation': [0.10, 0.25, 0.50],
-    'Total snow depth': [1,3,6,9,12]
 }
 
+manifest_index = ManifestIndex(JSON_DIR)
+
+# Member values at a point, read straight from the per-cycle member cubes
+plume_reader = PlumeReader(CUBE_DIR)
+
 def get_info(feature=None):
     header = [html.H4("Current Sample Value")]
     if not feature:
         return header
     return header + [html.H6(feature["properties"]["title"])]
 
-def get_available_hours(date):
-    subfolders = sorted(glob(JSON_DIR + '/' + str(date) + '/*/'))
+def scan_cycles():
+    """Cycles found by scanning JSON_DIR, for product directories written without a
+    manifest index (see manifest.py to build one).
+    """
+    cycles = []
+    for folder in sorted(glob(JSON_DIR + '/*/')):
+        subfolders = sorted([f.path for f in os.scandir(folder) if f.is_dir()])
+        for target in subfolders:
+            cycles.append(target[-13:])
+    return cycles
+
+def get_cycles():
+    """Available cycles (YYYY-MM-DD/HH), oldest first. Read from the manifest index,
+    which is only re-read when it changes.
+    """
+    cycles = manifest_index.refresh()
+    if cycles: return sorted(cycles.keys())
+    return scan_cycles()
 
+def get_available_hours(date):
     hours = []
-    for folder in subfolders:
-        HH = folder[-3:-1]
+    for cycle_str in get_cycles():
+        if cycle_str[:10] != str(date): continue
+        HH = cycle_str[-2:]
         hours.append(dict(label=HH, value=int(HH)))
     return hours
 
 def get_available_cyles():
-    # Add a check for the directory file size here...
-    dirs = sorted(glob(JSON_DIR + '/*/'))
-    date_times = []
-    for folder in dirs:
-        subfolders = sorted([f.path for f in os.scandir(folder) if f.is_dir()])
-        for target in subfolders:
-            datestring = target[-13:]
-            date_times.append(datetime.strptime(datestring, '%Y-%m-%d/%H'))
-    return date_times
+    return [datetime.strptime(cycle_str, '%Y-%m-%d/%H') for cycle_str in get_cycles()]
 
 def get_valid_time(cycle_str, fhr):
     dt = datetime.strptime(cycle_str, '%Y-%m-%d/%H') + timedelta(hours=int(fhr))
@@ -67,40 +110,111 @@ def get_valid_time(cycle_str, fhr):
 def get_minmax(classes):
     return dict(min=min(classes), max=max(classes))
 
-def get_data(cycle_str, fhr, parm, var_type, levels, threshold=None):
-    c = []
+def get_fname(cycle_str, fhr, parm, var_type, threshold=None):
     fname = "%s/%s/%s_%s.f%s" % (JSON_DIR, cycle_str, parm, var_type, str(fhr))
     if threshold:
-        fname = "%s/%s/%s_%s_%s.f%s" % (JSON_DIR, cycle_str, parm, var_type, threshold,
-                                        str(fhr))
-    with open(fname, 'r') as f: df = json.load(f)
-
-    # We could probably move these calculations into the create_geojson.py script to
-    # avoid having to do this here...
-    if not threshold:
-        knt = 1
-        for feature in df['features']:
-            feature['properties']['values'] = levels[knt]
-            knt += 1
-    return df
+        # Thresholds are formatted as the producer writes them, so 1 and 1.0 agree
+        fname = "%s/%s/%s_%s_%g.f%s" % (JSON_DIR, cycle_str, parm, var_type,
+                                        float(threshold), str(fhr))
+    return fname
+
+# Loaded products, so scrubbing back and forth through forecast hours doesn't re-read
+# and re-parse the same files
+product_cache = ProductCache()
+
+# Forecast hours on the slider, and how many on each side of the current one to load
+# ahead of time
+forecast_hours = list(range(3, 123, 3))
+prefetch_hours = 3
+prefetcher = Prefetcher(product_cache)
+
+# Products with precompressed copies (see precompress.py) are fetched by the browser
+# from this route rather than sent through callbacks.
+PRODUCT_ROUTE = '/products/'
+
+def get_tiles(cycle_str, fhr, parm, var_type, bounds, zoom, threshold=None):
+    """Tiles of a product that cover the map view, or None if the product was written
+    without a tile pyramid (create_geojson.py --tiles).
+    """
+    fname = get_fname(cycle_str, fhr, parm, var_type, threshold=threshold)
+    if bounds is None:
+        view = domains['MW']
+    else:
+        (lat0, lon0), (lat1, lon1) = bounds
+        view = [lon0, lon1, lat0, lat1]
+    return tiles.read_tiles(fname, view, zoom if zoom is not None else 6)
+
+def get_data(cycle_str, fhr, parm, var_type, threshold=None):
+    """Product contents, from product_cache when the file is unchanged. Products carry
+    their own 'values' properties (set in create_geojson.py), so they are served as-is.
+    """
+    fname = get_fname(cycle_str, fhr, parm, var_type, threshold=threshold)
+    try:
+        return product_cache.get((cycle_str, parm, var_type, threshold, fhr), fname)
+    except FileNotFoundError:
+        # Not written (yet) for this cycle and hour. Clear the map.
+        return {'type': 'FeatureCollection', 'features': []}
+
+def get_url(fname):
+    return PRODUCT_ROUTE + os.path.relpath(fname, JSON_DIR).replace(os.sep, '/')
+
+def get_neighbours(fhr):
+    """Forecast hours around fhr on the slider, nearest first.
+    """
+    if fhr not in forecast_hours: return []
+    idx = forecast_hours.index(fhr)
+    neighbours = []
+    for step in range(1, prefetch_hours+1):
+        for k in (idx + step, idx - step):
+            if 0 <= k < len(forecast_hours): neighbours.append(forecast_hours[k])
+    return neighbours
+
+def prefetch(cycle_str, fhr, parm, var_type, threshold=None):
+    """Load the neighbouring forecast hours of a product into product_cache in the
+    background, so the next slider step is a memory lookup.
+
+    Returns
+    -------
+    urls : list
+        For products the browser fetches itself, the neighbours' URLs to warm its cache
+    """
+    items = []
+    urls = []
+    for hour in get_neighbours(fhr):
+        fname = get_fname(cycle_str, hour, parm, var_type, threshold=threshold)
+        if os.path.exists(fname + precompress.SUFFIXES['gzip']):
+            urls.append(get_url(fname))
+        else:
+            items.append(((cycle_str, parm, var_type, threshold, hour), fname))
+    prefetcher.request(items)
+    return urls
+
+def get_raster(cycle_str, fhr, parm, var_type, threshold=None):
+    """URL and corner coordinates of a product's image (create_geojson.py --raster), or
+    None if it has none.
+    """
+    fname = get_fname(cycle_str, fhr, parm, var_type, threshold=threshold) + '.png'
+    if not os.path.exists(fname): return None
+    try:
+        with open("%s/%s/raster_bounds.json" % (JSON_DIR, cycle_str), 'r') as f:
+            bounds = json.load(f)
+    except (OSError, ValueError):
+        return None
+    return {'url': get_url(fname), 'bounds': bounds}
+
+def get_product(cycle_str, fhr, parm, var_type, threshold=None):
+    """A reference the browser resolves through PRODUCT_ROUTE, so the product arrives
+    precompressed and is cached. Products without precompressed copies are sent inline.
+    """
+    fname = get_fname(cycle_str, fhr, parm, var_type, threshold=threshold)
+    if os.path.exists(fname + precompress.SUFFIXES['gzip']):
+        return {'type': 'Product', 'url': get_url(fname)}
+    return get_data(cycle_str, fhr, parm, var_type, threshold=threshold)
 
 info = html.Div(children=get_info(), id="info", className="info",
                 style={"position": "absolute", "top": "10px", "right": "10px",
                        "z-index": "1000", 'color': '#000000'})
 
-# ...
-# Date and latest model cycle
-# ...
-current_time = datetime.utcnow()
-model_cycles = get_available_cyles()
-delta = current_time - model_cycles[-1]
-warn_str = "***WARNING: Latest available cycle is over %s hours old!***"
-old_data_warn = ""
-no_cycle_warn = ""
-if delta > timedelta(hours=12):
-    n_hours = int((delta.total_seconds() / 3600.))
-    old_data_warn = warn_str % (n_hours)
-
 # ...
 # Set the initial color configurations
 # ...
@@ -108,10 +222,9 @@ if delta > timedelta(hours=12):
 classes = qpf_levs
 colorscale = qpf_cols
 minmax = get_minmax(classes)
-cycle_string = model_cycles[-1].strftime('%Y-%m-%d/%H')
 #c = get_data(cycle_string, 3, 'qpf_03h', 'lpmm', classes)
 
-c = dl.GeoJSON(data=get_data(cycle_string, 3, 'qpf_03h', 'lpmm', classes),
+c = dl.GeoJSON(data=None,
                options=dict(style="window.local.module.set_style", weight=1,
                             fillOpacity=0.45),
                hideout=dict(colorscale=colorscale, classes=classes,
@@ -119,6 +232,9 @@ c = dl.GeoJSON(data=get_data(cycle_string, 3, 'qpf_03h', 'lpmm', classes),
                hoverStyle=dict(weight=2, opacity=0.7, color='Black'),
                id='contourf')
 
+# Image mode (create_geojson.py --raster). Hidden until a product image is shown.
+raster_layer = dl.ImageOverlay(id='raster', url='', bounds=[[0, 0], [0, 0]], opacity=0)
+
 # Create colorbar
 ctg = ["{}".format(cls, classes[i+1]) for i, cls in enumerate(classes[:-1])] \
        + ["{}+".format(classes[-1])]
@@ -138,182 +254,365 @@ mapbox_token = "pk.eyJ1IjoibGNhcmxhdyIsImEiOiJja2drMWM5dm0yMGZkMnFsN3NlNHZseGNmI
 #mapbox_token = settings.MAPBOX_TOKEN
 #mapbox_ids = ["light-v9", "dark-v9", "streets-v9", "outdoors-v9", "satellite-streets-v9"]
 app = dash.Dash(__name__, external_stylesheets=['/assets/style.css'])
-app.layout = html.Div(
-    [
-        html.Div(
-            [
-                html.H3("GEFSv12 Ensemble Viewer"),
-                html.Div(
-                    html.Center(
-                        [
-                            old_data_warn
-                        ]
+# A cycle's products never change once written, so they can be cached for good.
+# Repeat requests are answered from the browser cache or with a 304.
+@app.server.route(PRODUCT_ROUTE + '<path:path>')
+def serve_product(path):
+    root = os.path.realpath(JSON_DIR)
+    fname = os.path.realpath(os.path.join(root, path))
+    if not fname.startswith(root + os.sep): abort(404)
+    accept_encoding = request.headers.get('Accept-Encoding')
+    fname, encoding, etag = precompress.select(fname, accept_encoding)
+    if fname is None: abort(404)
+
+    headers = {'ETag': etag, 'Cache-Control': 'public, max-age=31536000, immutable',
+               'Vary': 'Accept-Encoding'}
+    if_none_match = request.headers.get('If-None-Match', '')
+    if_none_match = [tag.strip() for tag in if_none_match.split(',')]
+    if etag in if_none_match or '*' in if_none_match:
+        return Response(status=304, headers=headers)
+    if encoding is not None: headers['Content-Encoding'] = encoding
+    with open(fname, 'rb') as f: body = f.read()
+    mimetype = 'image/png' if path.endswith('.png') else 'application/json'
+    return Response(body, mimetype=mimetype, headers=headers)
+
+# e.g. /point?cycle=2021-01-01/00&var=apcp&lat=42.0&lon=-88.0
+@app.server.route('/point')
+def point():
+    try:
+        lat = float(request.args['lat'])
+        lon = float(request.args['lon'])
+        cycle_str = request.args['cycle']
+    except (KeyError, ValueError):
+        abort(400)
+    plume = plume_reader.plume(cycle_str, request.args.get('var', 'apcp'), lat, lon)
+    if plume is None: abort(404)
+    return jsonify(plume)
+
+# e.g. /boundaries/MW/counties.json. Built by boundaries.py.
+@app.server.route('/boundaries/<domain>/<kind>.json')
+def serve_boundaries(domain, kind):
+    if domain not in domains or kind not in boundaries.KINDS: abort(404)
+    geojson = boundaries.to_geojson(BOUNDARY_DIR, domain, kind)
+    if geojson is None: abort(404)
+    return Response(json.dumps(geojson, separators=(',', ':')),
+                    mimetype='application/json',
+                    headers={'Cache-Control': 'public, max-age=86400'})
+
+@app.server.route('/cache-stats')
+def cache_stats():
+    return jsonify(product_cache.stats())
+
+# The layout is built on every page load, so new cycles show up without a restart
+def serve_layout():
+    # ...
+    # Date and latest model cycle
+    # ...
+    current_time = datetime.utcnow()
+    model_cycles = get_available_cyles()
+    delta = current_time - model_cycles[-1]
+    warn_str = "***WARNING: Latest available cycle is over %s hours old!***"
+    old_data_warn = ""
+    if delta > timedelta(hours=12):
+        n_hours = int((delta.total_seconds() / 3600.))
+        old_data_warn = warn_str % (n_hours)
+
+    # Product data goes to the browser through this store. A clientside callback
+    # decodes it into the GeoJSON layer, so compact TopoJSON products are only
+    # expanded there.
+    cycle_string = model_cycles[-1].strftime('%Y-%m-%d/%H')
+
+    # County and state outlines from boundaries.py, if they have been built
+    overlays = []
+    for kind, name in [('counties', 'Counties'), ('states', 'States')]:
+        if not os.path.exists(boundaries.boundary_file(BOUNDARY_DIR, 'MW', kind)):
+            continue
+        layer = dl.GeoJSON(url='/boundaries/MW/%s.json' % (kind),
+                           options=dict(style="window.local.module.set_boundary_style"),
+                           id='%s-layer' % (kind))
+        overlays.append(dl.Overlay(layer, name=name, checked=False))
+    map_layers = [dl.TileLayer(url=mapbox_url), raster_layer, info, cbar, c]
+    if overlays: map_layers.append(dl.LayersControl(overlays, position='bottomright'))
+    contour_data = dcc.Store(id='contour-data',
+                             data=get_product(cycle_string, 3, 'qpf_03h', 'lpmm'))
+
+    return html.Div(
+        [
+            html.Div(
+                [
+                    html.H3("GEFSv12 Ensemble Viewer"),
+                    html.Div(
+                        html.Center(
+                            [
+                                old_data_warn
+                            ]
+                        ),
+                    style={'color': 'red', 'fontSize': 25}
                     ),
-                style={'color': 'red', 'fontSize': 25}
-                ),
-
-                html.Div([],
-                style={'height': '10px'},
-                ),
-
-                dcc.Slider(
-                    id='fhr',
-                    min=3,
-                    max=120,
-                    value=3,
-                    marks={str(fhr): str(fhr) for fhr in np.arange(3,123,3)},
-                    step=None
-                ),
-
-                dl.Map(center=[42, -88], zoom=6, children=[dl.TileLayer(url=mapbox_url), info, cbar, c],
-                style={'width': '100%', 'height': '850px', 'margin': "auto", "display": "block"}),
-            ],
-            style={'width': '83%', 'height': '100vh', 'display': 'inline-block'},
-        ),
-
-        html.Div(
-            [
-                html.Div(
-                    html.Center(
-                        [
-                            html.Td(
-                                id="no-cycle-warn"
-                            )
-                        ]
+
+                    html.Div([],
+                    style={'height': '10px'},
                     ),
-                style={'color': 'red', 'fontSize': 15, 'font-weight': 'bold'}
-                ),
 
-                # Hidden div inside app to store intermediate value
-                html.Div(
-                    id='hidden-value', style={'display': 'none'}
-                ),
+                    dcc.Slider(
+                        id='fhr',
+                        min=3,
+                        max=120,
+                        value=3,
+                        marks={str(fhr): str(fhr) for fhr in np.arange(3,123,3)},
+                        step=None
+                    ),
 
-                html.Table(
-                    [
-                        html.Tr(
-                            [
-                                html.Th("Model Cycle"),
-                                html.Th("Hour"),
-                                html.Th("Valid Time"),
-                            ]
-                        ),
-                        html.Tr(
+                    dl.Map(id='map', center=[42, -88], zoom=6, children=map_layers,
+                    style={'width': '100%', 'height': '850px', 'margin': "auto", "display": "block"}),
+
+                    # Member plume at the last clicked point
+                    html.Div(
+                        [
+                            dcc.RadioItems(
+                                id='plume-var',
+                                options=[{'label': CUBE_VARIABLES[var]['long_name'], 'value': var}
+                                         for var in CUBE_VARIABLES],
+                                value='apcp',
+                                labelStyle={'display': 'inline-block', 'margin-right': '10px'}
+                            ),
+                            dcc.Graph(id='plume', style={'height': '350px'}),
+                        ],
+                    ),
+                ],
+                style={'width': '83%', 'height': '100vh', 'display': 'inline-block'},
+            ),
+
+            html.Div(
+                [
+                    html.Div(
+                        html.Center(
                             [
                                 html.Td(
-                                    id="selected-date"
-                                ),
-                                html.Td(
-                                    id='selected-hour'
-                                ),
-                                html.Td(
-                                    id='valid-time'
+                                    id="no-cycle-warn"
                                 )
                             ]
-                        )
-                    ],
-                style={'margin-left': '5%', 'border-bottom': '2px solid #E1E1E1', 'width': '90%'}
-                ),
-
-                html.Div([],
-                style={'height': '10px'},
-                ),
-
-                html.H6("Model Cycle Selection"),
-                html.Table(
-                    [
-                        html.Tr(
-                            [
-                                html.Th('Cycle Date'),
-                                html.Th('Hour')
-                            ]
                         ),
-                        html.Tr(
-                            [
-                                html.Td(children=[
-                                    dcc.DatePickerSingle(
-                                        id='date-selection',
-                                        min_date_allowed=model_cycles[0].date(),
-                                        max_date_allowed=model_cycles[-1].date(),
-                                        initial_visible_month=model_cycles[-1].date(),
-                                        date=model_cycles[-1].date()
-                                    ),
+                    style={'color': 'red', 'fontSize': 15, 'font-weight': 'bold'}
+                    ),
+
+                    contour_data,
+
+                    # Hidden div inside app to store intermediate value
+                    html.Div(
+                        id='hidden-value', style={'display': 'none'}
+                    ),
+
+                    html.Table(
+                        [
+                            html.Tr(
+                                [
+                                    html.Th("Model Cycle"),
+                                    html.Th("Hour"),
+                                    html.Th("Valid Time"),
                                 ]
-                                ),
-                                html.Td(
-                                    dcc.Dropdown(
-                                        id='hour-selection',
-                                        options=get_available_hours(model_cycles[-1].date()),
-                                        placeholder=str(model_cycles[-1].hour).zfill(2),
-                                        value=str(model_cycles[-1].hour).zfill(2)
+                            ),
+                            html.Tr(
+                                [
+                                    html.Td(
+                                        id="selected-date"
                                     ),
-                                style={'color': '#000000'}
-                                )
-                            ]
-                        ),
-                    html.Tr([])
-                    ],
-                    style={'margin-left': '5%', 'width': '90%'}
-                ),
-
-                html.Div([],
-                style={'height': '10px'},
-                ),
-
-                html.Div(
-                    [
-                        html.H6("Parameter Selection"),
-                        html.Div(
-                            [
-                                dcc.Dropdown(
-                                    id='parm-selection',
-                                    options=[{'label': i, 'value': i} for i in parameters.keys()],
-                                    value=list(parameters.keys())[0]
-                                ),
-                            ],
-                            style={'margin-left': '5%', 'width': '90%', 'color': '#000000'},
-                        ),
+                                    html.Td(
+                                        id='selected-hour'
+                                    ),
+                                    html.Td(
+                                        id='valid-time'
+                                    )
+                                ]
+                            )
+                        ],
+                    style={'margin-left': '5%', 'border-bottom': '2px solid #E1E1E1', 'width': '90%'}
+                    ),
 
-                        html.Div([],
-                        style={'height': '10px'},
-                        ),
+                    html.Div([],
+                    style={'height': '10px'},
+                    ),
 
-                        html.H6("Variable Selection"),
-                        html.Div(
-                            [
-                                dcc.RadioItems(
-                                    id='var-type',
-                                    options=[{'label': i, 'value': i} for i in variable_types.keys()],
-                                    value=list(variable_types.keys())[0]
-                                ),
-                            ],
-                            style={'margin-left': '5%','width': '90%'},
-                        ),
+                    html.H6("Model Cycle Selection"),
+                    html.Table(
+                        [
+                            html.Tr(
+                                [
+                                    html.Th('Cycle Date'),
+                                    html.Th('Hour')
+                                ]
+                            ),
+                            html.Tr(
+                                [
+                                    html.Td(children=[
+                                        dcc.DatePickerSingle(
+                                            id='date-selection',
+                                            min_date_allowed=model_cycles[0].date(),
+                                            max_date_allowed=model_cycles[-1].date(),
+                                            initial_visible_month=model_cycles[-1].date(),
+                                            date=model_cycles[-1].date()
+                                        ),
+                                    ]
+                                    ),
+                                    html.Td(
+                                        dcc.Dropdown(
+                                            id='hour-selection',
+                                            options=get_available_hours(model_cycles[-1].date()),
+                                            placeholder=str(model_cycles[-1].hour).zfill(2),
+                                            value=str(model_cycles[-1].hour).zfill(2)
+                                        ),
+                                    style={'color': '#000000'}
+                                    )
+                                ]
+                            ),
+                        html.Tr([])
+                        ],
+                        style={'margin-left': '5%', 'width': '90%'}
+                    ),
 
-                        html.Div([],
-                        style={'height': '10px'},
-                        ),
+                    html.Div([],
+                    style={'height': '10px'},
+                    ),
 
-                        # Default to
-                        html.H6("Threshold Selection"),
-                        html.Div(
-                            [
-                                dcc.Dropdown(
-                                    id='threshold-selection',
-                                    options=[{'label': i, 'value': i} for i in thresholds[list(parameters.keys())[0]]],
-                                    value=thresholds[list(parameters.keys())[0]][0]
-                                ),
-                            ],
-                            style={'margin-left': '5%', 'width': '90%', 'color': '#000000'},
-                        ),
-                    ],
-                ),
-            ],
-            style={'width': '16.5%', 'height': '100vh', 'float': 'right',
-                   'display': 'inline-block', 'background-color':'#1d1d1d'},
-        ),
-    ]
-)
+                    html.Div(
+                        [
+                            html.H6("Parameter Selection"),
+                            html.Div(
+                                [
+                                    dcc.Dropdown(
+                                        id='parm-selection',
+                                        options=[{'label': i, 'value': i} for i in parameters.keys()],
+                                        value=list(parameters.keys())[0]
+                                    ),
+                                ],
+                                style={'margin-left': '5%', 'width': '90%', 'color': '#000000'},
+                            ),
+
+                            html.Div([],
+                            style={'height': '10px'},
+                            ),
+
+                            html.H6("Variable Selection"),
+                            html.Div(
+                                [
+                                    dcc.RadioItems(
+                                        id='var-type',
+                                        options=[{'label': i, 'value': i} for i in variable_types.keys()],
+                                        value=list(variable_types.keys())[0]
+                                    ),
+                                ],
+                                style={'margin-left': '5%','width': '90%'},
+                            ),
+
+                            html.Div([],
+                            style={'height': '10px'},
+                            ),
+
+                            # Images draw dense fields faster than filled polygons. The
+                            # polygons are still loaded, unstyled, for hover values.
+                            html.H6("Display"),
+                            html.Div(
+                                [
+                                    dcc.RadioItems(
+                                        id='display-mode',
+                                        options=[{'label': 'Vector', 'value': 'vector'},
+                                                 {'label': 'Image', 'value': 'image'}],
+                                        value='vector',
+                                        labelStyle={'display': 'inline-block',
+                                                    'margin-right': '10px'}
+                                    ),
+                                ],
+                                style={'margin-left': '5%','width': '90%'},
+                            ),
+
+                            html.Div([],
+                            style={'height': '10px'},
+                            ),
+
+                            # Default to
+                            html.H6("Threshold Selection"),
+                            html.Div(
+                                [
+                                    dcc.Dropdown(
+                                        id='threshold-selection',
+                                        options=[{'label': i, 'value': i} for i in thresholds[list(parameters.keys())[0]]],
+                                        value=thresholds[list(parameters.keys())[0]][0]
+                                    ),
+                                ],
+                                style={'margin-left': '5%', 'width': '90%', 'color': '#000000'},
+                            ),
+
+                            html.Div([],
+                            style={'height': '10px'},
+                            ),
+
+                            # Loops through every forecast hour of the selected product in
+                            # the browser. See show_contours in assets/func.js.
+                            html.H6("Animation"),
+                            html.Div(
+                                [
+                                    dcc.Checklist(
+                                        id='animation-toggle',
+                                        options=[{'label': 'Loop forecast hours', 'value': 'loop'}],
+                                        value=[]
+                                    ),
+                                    html.Div(id='animation-hour'),
+                                    dcc.Interval(id='animation-timer', interval=500,
+                                                 disabled=True),
+                                    dcc.Store(id='animation-data'),
+                                ],
+                                style={'margin-left': '5%', 'width': '90%'},
+                            ),
+                        ],
+                    ),
+                ],
+                style={'width': '16.5%', 'height': '100vh', 'float': 'right',
+                       'display': 'inline-block', 'background-color':'#1d1d1d'},
+            ),
+        ]
+    )
+
+app.layout = serve_layout
+
+def plume_figure(plume, var, lat, lon):
+    """Plotly figure of every member's values over the forecast hours.
+    """
+    figure = {'data': [], 'layout': {
+        'title': "Click the map for a member plume",
+        'xaxis': {'title': 'Forecast hour'},
+        'yaxis': {'title': CUBE_VARIABLES[var]['units']},
+        'showlegend': False,
+        'margin': {'l': 50, 'r': 20, 't': 40, 'b': 40},
+    }}
+    if plume is None: return figure
+
+    values = np.array([[np.nan if v is None else v for v in row]
+                       for row in plume['values']], dtype=np.float64)
+    for k, member in enumerate(plume['members']):
+        color = matplotlib.colors.to_hex(spag_cols[k % len(spag_cols)][0:3])
+        figure['data'].append({'x': plume['hours'], 'y': values[k].tolist(),
+                               'name': member, 'mode': 'lines',
+                               'line': {'width': 1, 'color': color}})
+    if values.size:
+        figure['data'].append({'x': plume['hours'],
+                               'y': np.nanmean(values, axis=0).tolist(),
+                               'name': 'Mean', 'mode': 'lines',
+                               'line': {'width': 3, 'color': 'black'}})
+    figure['layout']['title'] = "%s at %.2f, %.2f (grid point %.2f, %.2f)" % (
+        CUBE_VARIABLES[var]['long_name'], lat, lon, plume['grid_lat'], plume['grid_lon'])
+    return figure
+
+@app.callback(Output('plume', 'figure'),
+              [Input('map', 'click_lat_lng'),
+               Input('plume-var', 'value'),
+               Input('date-selection', 'date'),
+               Input('hour-selection', 'value')])
+def update_plume(click_lat_lng, var, date, hour):
+    if not click_lat_lng: return plume_figure(None, var, None, None)
+    lat, lon = click_lat_lng
+    cycle_str = date + '/' + str(hour).zfill(2)
+    plume = plume_reader.plume(cycle_str, var, lat, lon)
+    return plume_figure(plume, var, lat, lon)
 
 # For the sampling output
 @app.callback(Output("info", "children"), [Input("contourf", "hover_feature")])
@@ -340,9 +639,10 @@ def update_date(date_value):
     # throwing a visible error now,
     if len(hours) < 1:
         no_cycle_warn = "No cycles available for: %s" % (date_string)
-        hours = get_available_hours(model_cycles[-1].date())
+        latest_cycle = get_available_cyles()[-1]
+        hours = get_available_hours(latest_cycle.date())
         latest_available = hours[-1]['label']
-        date_string = str(model_cycles[-1].date())
+        date_string = str(latest_cycle.date())
 
     # Good to go. Update with the selected date, and default to the most recent hour.
     else:
@@ -366,8 +666,72 @@ def individual_members(selection):
     return members[0]
 '''
 
+# Only offer the variable types that exist for the parameter
+@app.callback([Output('var-type', 'options'),
+               Output('var-type', 'value')],
+              [Input('parm-selection', 'value')],
+              [State('var-type', 'value')])
+def update_var_types(parm_selection, current):
+    types = parameter_types[parameters[parm_selection]]
+    labels = [label for label, var_type in variable_types.items() if var_type in types]
+    options = [{'label': i, 'value': i} for i in labels]
+    if current in labels: return options, current
+    return options, labels[0]
+
+# Spaghetti and probability products each have their own thresholds
+@app.callback([Output('threshold-selection', 'options'),
+               Output('threshold-selection', 'value')],
+              [Input('parm-selection', 'value'),
+               Input('var-type', 'value')],
+              [State('threshold-selection', 'value')])
+def update_thresholds(parm_selection, var_selection, current):
+    if variable_types[var_selection] == 'prob':
+        values = prob_thresholds[parameters[parm_selection]]
+    else:
+        values = thresholds.get(parm_selection, [])
+    options = [{'label': i, 'value': i} for i in values]
+    if current in values: return options, current
+    return options, values[0] if values else None
+
+app.clientside_callback(
+    ClientsideFunction(namespace='local', function_name='show_contours'),
+    [Output('contourf', 'data'),
+     Output('animation-hour', 'children')],
+    [Input('contour-data', 'data'),
+     Input('animation-timer', 'n_intervals'),
+     Input('animation-data', 'data')])
+
+# Loop mode. Every available forecast hour of the selected product is handed to the
+# browser once; frames are then switched client-side with no server work per frame.
+@app.callback([Output('animation-data', 'data'),
+               Output('animation-timer', 'disabled')],
+              [Input('animation-toggle', 'value'),
+               Input("parm-selection", "value"),
+               Input("var-type", "value"),
+               Input("threshold-selection", "value"),
+               Input('date-selection', 'date'),
+               Input('hour-selection', 'value')])
+def update_animation(toggle, parm_selection, var_selection, threshold, date, hour):
+    if 'loop' not in (toggle or []): return None, True
+
+    cycle_str = date + '/' + str(hour).zfill(2)
+    parm = parameters[parm_selection]
+    var_type = variable_types[var_selection]
+    if var_type not in threshold_types: threshold = None
+
+    hours = []
+    frames = []
+    for fhr in forecast_hours:
+        fname = get_fname(cycle_str, fhr, parm, var_type, threshold=threshold)
+        if not os.path.exists(fname): continue
+        hours.append(fhr)
+        frames.append(get_product(cycle_str, fhr, parm, var_type, threshold=threshold))
+    if not hours: return None, True
+    key = "%s/%s_%s_%s" % (cycle_str, parm, var_type, threshold)
+    return {'key': key, 'hours': hours, 'frames': frames}, False
+
 # Updating the figure
-@app.callback([Output("contourf", "data"),
+@app.callback([Output("contour-data", "data"),
                Output("contourf", "hideout"),
                Output("contourf", "options"),
                Output("cbar", "max"),
@@ -375,14 +739,22 @@ def individual_members(selection):
                Output("cbar", "tickText"),
                Output("cbar", "classes"),
                Output("cbar", "colorscale"),
-               Output("valid-time", "children")],
+               Output("valid-time", "children"),
+               Output("raster", "url"),
+               Output("raster", "bounds"),
+               Output("raster", "opacity")],
               [Input("fhr", "value"),
                Input("parm-selection", "value"),
                Input("var-type", "value"),
                Input("threshold-selection", "value"),
                Input('date-selection', 'date'),
-               Input('hour-selection', 'value')])
-def update(fhr, parm_selection, var_selection, threshold, date, hour):
+               Input('hour-selection', 'value'),
+               Input('map', 'bounds'),
+               Input('map', 'zoom'),
+               Input('display-mode', 'value'),
+               Input('animation-toggle', 'value')])
+def update(fhr, parm_selection, var_selection, threshold, date, hour, bounds, zoom,
+           display_mode, toggle):
     cycle_str = date + '/' + str(hour).zfill(2)
     valid_time = get_valid_time(cycle_str, fhr)
     parm = parameters[parm_selection]
@@ -397,12 +769,37 @@ def update(fhr, parm_selection, var_selection, threshold, date, hour):
         classes = snow_levs
         colorscale = snow_cols
 
+    elif parm in ['gust10m']:
+        classes = gust_levs
+        colorscale = gust_cols
+
+    if var_type == 'prob':
+        classes = prob_levs
+        colorscale = prob_cols
+
+    # Spaghetti contours are lines, so they are always drawn as vectors. So are loops:
+    # their frames are swapped in the vector layer only.
+    product_threshold = threshold if var_type in threshold_types else None
+    image = None
+    if display_mode == 'image' and var_type != 'sp' and 'loop' not in (toggle or []):
+        image = get_raster(cycle_str, fhr, parm, var_type, threshold=product_threshold)
+
+    # Panning and zooming only matter for products with a tile pyramid
+    fname = get_fname(cycle_str, fhr, parm, var_type, threshold=product_threshold)
+    triggers = [item['prop_id'] for item in dash.callback_context.triggered]
+    if triggers and all(t in ('map.bounds', 'map.zoom') for t in triggers) and \
+            not os.path.exists(tiles.tile_dir(fname)):
+        raise PreventUpdate
+
     if var_type == 'sp':
         colorscale = []
         for color in spag_cols:
             colorscale.append(matplotlib.colors.to_hex(list(color[0:3])))
         classes = spag_levs
-        data = get_data(cycle_str, fhr, parm, var_type, classes, threshold=threshold)
+        data = get_tiles(cycle_str, fhr, parm, var_type, bounds, zoom,
+                         threshold=threshold)
+        if data is None:
+            data = get_product(cycle_str, fhr, parm, var_type, threshold=threshold)
         hideout = dict(colorscale=colorscale, classes=classes, color_prop="values"),
         ctg = ["{}".format(cls, classes[i+1]) for i, cls in enumerate(classes[:-1])] \
                + ["{}+".format(classes[-1])]
@@ -411,7 +808,10 @@ def update(fhr, parm_selection, var_selection, threshold, date, hour):
                        fillOpacity=0.025)
         #options = dict(fill=False)
     else:
-        data = get_data(cycle_str, fhr, parm, var_type, classes)
+        data = get_tiles(cycle_str, fhr, parm, var_type, bounds, zoom,
+                         threshold=product_threshold)
+        if data is None:
+            data = get_product(cycle_str, fhr, parm, var_type, threshold=product_threshold)
         minmax = get_minmax(classes)
         hideout = dict(colorscale=colorscale, classes=classes, color_prop="values"),
 
@@ -420,7 +820,23 @@ def update(fhr, parm_selection, var_selection, threshold, date, hour):
         indices = list(range(len(ctg)))
         options = dict(style="window.local.module.set_style", weight=1, fillOpacity=0.45)
 
-    return data, hideout, options, len(ctg), indices, ctg, indices, colorscale, valid_time
+    if image is not None:
+        raster = image['url'], image['bounds'], 0.8
+    else:
+        raster = dash.no_update, dash.no_update, 0
+
+    if data.get('type') != 'TileSet' and not data.get('tiled'):
+        urls = prefetch(cycle_str, fhr, parm, var_type, threshold=product_threshold)
+        if data.get('type') == 'Product': data = dict(data, prefetch=urls)
+
+    # Tile edges cut through polygons. Leave out the outlines so they don't show.
+    if data.get('type') == 'TileSet' or data.get('tiled'):
+        options['style'] = "window.local.module.set_tile_style"
+    # The image draws the fill. The polygons stay on top, unseen, for hover values.
+    if image is not None:
+        options['style'] = "window.local.module.set_hover_style"
+    return (data, hideout, options, len(ctg), indices, ctg, indices, colorscale,
+            valid_time) + raster
 
 
 if __name__ == '__main__':
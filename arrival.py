@@ -0,0 +1,128 @@
+import os
+import time
+from datetime import datetime
+
+# inotify is only available on Linux. Elsewhere, fall back to quick stat polling.
+try:
+    from inotify_simple import INotify, flags
+except ImportError:
+    INotify = None
+
+def timestamp(str1, str2):
+    """Print out some simple date and time information for log files
+    """
+
+    print("%s  %s : %s" % (str1, datetime.strftime(datetime.now(), "%c"), str2))
+
+def has_end_marker(fname):
+    """Whether a GRIB file ends with the '7777' end-of-message marker.
+
+    Parameters
+    ----------
+    fname : str
+        Full path to file
+    """
+    try:
+        with open(fname, 'rb') as f:
+            f.seek(-4, os.SEEK_END)
+            return f.read(4) == b'7777'
+    except OSError:
+        return False
+
+class ArrivalScheduler():
+    def __init__(self, dir_, files, **kwargs):
+        """Hand out forecast hours for processing as soon as every member file for the
+        hour has fully arrived, while later hours are still downloading.
+
+        A file counts as complete once it ends with a GRIB end marker and has not been
+        modified for `settle` seconds. A writer can close a file and reopen it to
+        append more messages, so closing alone isn't enough. With inotify, files
+        closed or moved into dir_ wake the scheduler instead of the next poll.
+
+        If no file completes within `timeout` seconds, hours() stops early and
+        timed_out is set.
+
+        Parameters
+        ----------
+        dir_ : str
+            Directory the files are downloaded into
+        files : list
+            For each forecast hour, the list of member files to wait for
+
+        Optional Parameters
+        -------------------
+        poll : float
+            Seconds between checks when no inotify event arrives. Default = 2
+        settle : float
+            Seconds a file must go unmodified to count as complete. Default = 10
+        timeout : float
+            Give up if no new file completes within this many seconds. Default = 5400
+        """
+        self.dir_ = dir_
+        self.files = files
+        self.poll = kwargs.get('poll', 2.)
+        self.settle = kwargs.get('settle', 10.)
+        self.timeout = kwargs.get('timeout', 5400.)
+
+        self.timed_out = False
+        self._complete = set()
+        self._inotify = None
+        self._add_watch()
+
+    def _add_watch(self):
+        if INotify is None or self._inotify is not None or not os.path.isdir(self.dir_):
+            return
+        self._inotify = INotify()
+        self._inotify.add_watch(self.dir_, flags.CLOSE_WRITE | flags.MOVED_TO)
+
+    def _wait(self):
+        """Block until something changes in the download directory, or for at most one
+        polling interval.
+        """
+        if self._inotify is None:
+            time.sleep(self.poll)
+            self._add_watch()
+            return
+        self._inotify.read(timeout=int(self.poll * 1000))
+
+    def is_complete(self, fname):
+        """Check, and remember, whether a file has fully arrived.
+
+        Parameters
+        ----------
+        fname : str
+            Full path to file
+        """
+        if fname in self._complete: return True
+        try:
+            stat = os.stat(fname)
+        except OSError:
+            return False
+
+        stable = time.time() - stat.st_mtime >= self.settle
+        if stat.st_size > 0 and stable and has_end_marker(fname):
+            self._complete.add(fname)
+            return True
+        return False
+
+    def hours(self):
+        """Generator of (t, fnames) for each forecast hour, in order, as soon as all of
+        its files are complete. Stops early, setting timed_out, if the timeout is
+        reached.
+        """
+        last_arrival = time.time()
+        for t, fnames in enumerate(self.files):
+            n_complete = len(self._complete)
+            while not all([self.is_complete(fname) for fname in fnames]):
+                if len(self._complete) > n_complete:
+                    n_complete = len(self._complete)
+                    last_arrival = time.time()
+                if time.time() - last_arrival > self.timeout:
+                    missing = [f for f in fnames if f not in self._complete]
+                    timestamp("[ERROR]", "timed out waiting for %s" % (missing[0]))
+                    self.timed_out = True
+                    return
+                self._wait()
+            last_arrival = time.time()
+            for fname in fnames: timestamp("[INFO]", fname)
+            yield t, fnames
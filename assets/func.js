@@ -7,6 +7,164 @@ window.local = Object.assign({}, window.local, {
                 opacity: 0.7,
                 stroke: true,
             };
+        },
+        // Tiled products are cut at tile edges, so only the fill is drawn
+        set_tile_style: function(feature) {
+            return {
+                fillColor: feature.properties.fill,
+                stroke: false,
+            };
+        },
+        // Invisible polygons over a product image, so hovering still shows values
+        set_hover_style: function(feature) {
+            return {
+                fillOpacity: 0,
+                stroke: false,
+            };
+        },
+        // County and state outlines (boundaries.py)
+        set_boundary_style: function(feature) {
+            return {
+                color: feature.properties.kind == 'counties' ? '#808080' : '#000000',
+                weight: feature.properties.kind == 'counties' ? 0.5 : 1,
+                fill: false,
+            };
+        }
+    }
+});
+
+// Product files written with create_geojson.py --format topojson hold quantized,
+// delta-encoded arcs that neighbouring bands share. Rebuild the GeoJSON the map
+// layer expects. Plain GeoJSON is passed through unchanged. A TileSet holds one
+// topology per map tile (tiles.py), and their features are merged.
+function decode_topology(topology) {
+    if (topology && topology.type === 'TileSet') {
+        var merged = [];
+        topology.tiles.forEach(function(tile) {
+            merged = merged.concat(decode_topology(tile).features);
+        });
+        return {type: 'FeatureCollection', features: merged};
+    }
+    if (!topology || topology.type !== 'Topology') {
+        return topology;
+    }
+    var scale = topology.transform.scale;
+    var translate = topology.transform.translate;
+    var arcs = topology.arcs.map(function(arc) {
+        var x = 0, y = 0;
+        return arc.map(function(delta) {
+            x += delta[0];
+            y += delta[1];
+            return [x * scale[0] + translate[0], y * scale[1] + translate[1]];
+        });
+    });
+
+    function ring(refs) {
+        var points = [];
+        refs.forEach(function(ref) {
+            var arc = ref >= 0 ? arcs[ref] : arcs[~ref].slice().reverse();
+            points = points.concat(points.length ? arc.slice(1) : arc);
+        });
+        return points;
+    }
+
+    var features = [];
+    var objects = topology.objects;
+    Object.keys(objects).forEach(function(name) {
+        objects[name].geometries.forEach(function(geometry) {
+            if (!geometry.type) {
+                return;
+            }
+            features.push({
+                type: 'Feature',
+                properties: geometry.properties,
+                geometry: {
+                    type: 'MultiPolygon',
+                    coordinates: geometry.arcs.map(function(polygon) {
+                        return polygon.map(ring);
+                    })
+                }
+            });
+        });
+    });
+    return {type: 'FeatureCollection', features: features};
+}
+
+// Products served from the /products route arrive as a reference. They are fetched
+// here so the browser cache and the precompressed copies are used. The neighbouring
+// forecast hours listed in 'prefetch' are requested in the background. Returns a
+// Promise of the decoded product, so the page never waits on the request.
+function load_contours(data) {
+    if (!data || data.type !== 'Product') {
+        return Promise.resolve(decode_topology(data));
+    }
+    var prefetch = data.prefetch || [];
+    return fetch(data.url).then(function(response) {
+        if (!response.ok) {
+            return null;
         }
+        return response.json();
+    }).then(function(product) {
+        // Warm the browser cache with the neighbouring forecast hours
+        prefetch.forEach(function(url) {
+            fetch(url).catch(function() {});
+        });
+        return decode_topology(product);
+    });
+}
+
+// Decoded frames of the current animation, kept between timer ticks. 'frames' stays
+// null until every frame has arrived, and the loop counts from the tick it arrived on.
+var animation = {key: null, frames: null, start: 0, tick: 0};
+
+// Calls to show_contours so far. A product that arrives after a newer call was made
+// is dropped rather than drawn over the newer one.
+var latest = 0;
+
+function frame_label(hour) {
+    hour = String(hour);
+    while (hour.length < 3) {
+        hour = '0' + hour;
+    }
+    return 'F' + hour;
+}
+
+// Shows the selected product, or in loop mode the animation frame for this tick.
+// All frames are fetched together and decoded once, when a new animation arrives.
+// Ticks before then leave the map as it is.
+function show_contours(data, n_intervals, animation_data) {
+    var no_update = window.dash_clientside.no_update;
+    var call = ++latest;
+    if (!animation_data) {
+        animation = {key: null, frames: null, start: 0, tick: 0};
+        return load_contours(data).then(function(contours) {
+            return call === latest ? [contours, ''] : no_update;
+        });
+    }
+    animation.tick = n_intervals || 0;
+    if (animation.key !== animation_data.key) {
+        var key = animation_data.key;
+        animation = {key: key, frames: null, start: 0, tick: n_intervals || 0};
+        return Promise.all(animation_data.frames.map(load_contours)).then(function(frames) {
+            if (animation.key !== key) {
+                return no_update;
+            }
+            animation.frames = frames;
+            animation.start = animation.tick;
+            return [frames[0], frame_label(animation_data.hours[0])];
+        });
+    }
+    if (!animation.frames) {
+        return no_update;
+    }
+    var k = (animation.tick - animation.start) % animation.frames.length;
+    return [animation.frames[k], frame_label(animation_data.hours[k])];
+}
+
+window.dash_clientside = Object.assign({}, window.dash_clientside, {
+    local: {
+        decode_topology: decode_topology,
+        load_contours: load_contours,
+        show_contours: show_contours
     }
 });
@@ -0,0 +1,151 @@
+"""
+County, state and coastline outlines, clipped to each plotting domain in mapinfo.py and
+simplified to about one output pixel, so maps don't have to read and draw the full
+shapefiles on every run. Build once (or after changing mapinfo.domains) with
+
+    python boundaries.py
+
+Each domain and kind is kept in its own small .npz:
+    <BOUNDARY_DIR>/<domain>_<kind>.npz
+        coords : int16 (K x 2) lon/lat offsets from origin, in units of 1/scale degree
+        starts : int32 offset of each line in coords, plus the total length
+        origin : [lon, lat]
+        scale : float
+"""
+import os
+import numpy as np
+from mapinfo import domains
+
+KINDS = ('counties', 'states', 'coastlines')
+
+# Lines as drawn by plot.Plot.add_features
+STYLES = {
+    'counties': {'colors': 'darkgrey', 'linewidths': 0.5},
+    'states': {'colors': 'black', 'linewidths': 1},
+    'coastlines': {'colors': 'black', 'linewidths': 1},
+}
+
+# Loaded boundaries, by file
+_cache = {}
+
+def boundary_file(boundary_dir, domain, kind):
+    return "%s/%s_%s.npz" % (boundary_dir, domain, kind)
+
+def _lines(geom):
+    """Coordinate arrays (Nx2) of every line in a shapely geometry. Polygons give their
+    outlines.
+    """
+    if geom.is_empty: return
+    if geom.geom_type in ('Polygon', 'MultiPolygon'): geom = geom.boundary
+    if geom.geom_type in ('LineString', 'LinearRing'):
+        yield np.asarray(geom.coords)[:,:2]
+    elif hasattr(geom, 'geoms'):
+        for part in geom.geoms:
+            yield from _lines(part)
+
+def _sources(county_shapefile):
+    """Shapefile geometries of each kind. The states and coastlines are the Natural Earth
+    1:50m sets cartopy draws.
+    """
+    import cartopy.io.shapereader as shpreader
+    states = shpreader.natural_earth(resolution='50m', category='cultural',
+                                     name='admin_1_states_provinces_lakes')
+    coastlines = shpreader.natural_earth(resolution='50m', category='physical',
+                                         name='coastline')
+    return {
+        'counties': county_shapefile,
+        'states': states,
+        'coastlines': coastlines,
+    }
+
+def build(county_shapefile, boundary_dir, **kwargs):
+    """Clip, simplify and save the boundaries of every domain.
+
+    Parameters
+    ----------
+    county_shapefile : str
+        County line shapefile (countyl010g.shp)
+    boundary_dir : str
+        Output directory
+
+    Optional Parameters
+    -------------------
+    pixels : int
+        Output image width the lines are simplified for. Default = 1200
+    margin : float
+        Degrees added on every side of each domain, to cover the map's aspect-ratio
+        padding. Default = 5
+    """
+    import cartopy.io.shapereader as shpreader
+    from shapely.geometry import box
+
+    pixels = kwargs.get('pixels', 1200)
+    margin = kwargs.get('margin', 5.)
+    if not os.path.exists(boundary_dir): os.makedirs(boundary_dir)
+
+    for kind, fname in _sources(county_shapefile).items():
+        geometries = list(shpreader.Reader(fname).geometries())
+        for name, bounds in domains.items():
+            clip = [bounds[0]-margin, bounds[1]+margin, bounds[2]-margin, bounds[3]+margin]
+            # Half a pixel across the map
+            tolerance = 0.5 * (clip[1] - clip[0]) / pixels
+            clip_box = box(clip[0], clip[2], clip[1], clip[3])
+
+            lines = []
+            for geom in geometries:
+                x0, y0, x1, y1 = geom.bounds
+                if x1 < clip[0] or x0 > clip[1] or y1 < clip[2] or y0 > clip[3]: continue
+                if geom.geom_type in ('Polygon', 'MultiPolygon'): geom = geom.boundary
+                geom = geom.intersection(clip_box).simplify(tolerance,
+                                                            preserve_topology=False)
+                lines += [line for line in _lines(geom) if line.shape[0] > 1]
+            save(boundary_file(boundary_dir, name, kind), lines, clip)
+
+def save(fname, lines, bounds):
+    """Quantize lines relative to the corner of bounds and save them.
+    """
+    origin = np.array([bounds[0], bounds[2]])
+    # int16 offsets: the finest step that still spans the clip box
+    span = max(bounds[1] - bounds[0], bounds[3] - bounds[2])
+    scale = np.floor(32767. / span)
+    starts = np.cumsum([0] + [line.shape[0] for line in lines]).astype(np.int32)
+    coords = np.zeros((starts[-1], 2), dtype=np.int16)
+    if lines:
+        coords[:] = np.rint((np.concatenate(lines) - origin) * scale)
+    tmp_name = "%s.%d.tmp.npz" % (fname[:-4], os.getpid())
+    np.savez(tmp_name, coords=coords, starts=starts, origin=origin, scale=scale)
+    os.replace(tmp_name, fname)
+
+def load(boundary_dir, domain, kind):
+    """Preprocessed lines of one kind for a domain.
+
+    Returns
+    -------
+    lines : list
+        Lon/lat arrays (Nx2), one per line. None if the boundaries haven't been built.
+    """
+    fname = boundary_file(boundary_dir, domain, kind)
+    if fname not in _cache:
+        try:
+            with np.load(fname) as f:
+                coords = f['coords'] / f['scale'] + f['origin']
+                starts = f['starts']
+        except OSError:
+            return None
+        _cache[fname] = np.split(coords, starts[1:-1])
+    return _cache[fname]
+
+def to_geojson(boundary_dir, domain, kind, ndigits=3):
+    """Lines of one kind for a domain as a GeoJSON MultiLineString, for map overlays.
+    None if the boundaries haven't been built.
+    """
+    lines = load(boundary_dir, domain, kind)
+    if lines is None: return None
+    coords = [np.round(line, ndigits).tolist() for line in lines]
+    return {'type': 'FeatureCollection', 'features': [{
+        'type': 'Feature', 'properties': {'kind': kind},
+        'geometry': {'type': 'MultiLineString', 'coordinates': coords}}]}
+
+if __name__ == '__main__':
+    from plotconfigs import COUNTY_SHAPEFILE, BOUNDARY_DIR
+    build(COUNTY_SHAPEFILE, BOUNDARY_DIR)
@@ -0,0 +1,76 @@
+import os
+import json
+
+class Checkpoint():
+    def __init__(self, fname, layout):
+        """Record of which forecast hours of a cycle have been fully processed, and
+        from which input files. An hour only counts as complete if its input files are
+        unchanged and all of its products are still on disk.
+
+        Parameters
+        ----------
+        fname : str
+            Checkpoint file (JSON)
+        layout : dict
+            Anything that changes the output for every hour, such as the processing
+            domain. A checkpoint written with a different layout is discarded.
+        """
+        self.fname = fname
+        self.state = {'layout': layout, 'hours': {}}
+        try:
+            with open(fname, 'r') as f: state = json.load(f)
+            if state.get('layout') == layout: self.state = state
+        except (OSError, ValueError):
+            pass
+
+    @staticmethod
+    def input_state(fnames):
+        """Size and modification time of each input file.
+        """
+        inputs = {}
+        for fname in fnames:
+            stat = os.stat(fname)
+            inputs[os.path.basename(fname)] = [stat.st_size, stat.st_mtime]
+        return inputs
+
+    def is_complete(self, hour, fnames):
+        """Whether a forecast hour can be skipped.
+
+        Parameters
+        ----------
+        hour : int
+            Forecast hour
+        fnames : list
+            Input files for this hour
+
+        Returns
+        -------
+        bool
+        """
+        entry = self.state['hours'].get(str(int(hour)))
+        if entry is None: return False
+        try:
+            if entry['inputs'] != self.input_state(fnames): return False
+        except OSError:
+            return False
+        return all(os.path.exists(product) for product in entry['products'])
+
+    def mark_complete(self, hour, fnames, products):
+        """Record a forecast hour as complete and save the checkpoint.
+
+        Parameters
+        ----------
+        hour : int
+            Forecast hour
+        fnames : list
+            Input files for this hour
+        products : list
+            Output files written for this hour
+        """
+        self.state['hours'][str(int(hour))] = {
+            'inputs': self.input_state(fnames),
+            'products': sorted(products),
+        }
+        tmp_name = self.fname + '.tmp'
+        with open(tmp_name, 'w') as f: json.dump(self.state, f)
+        os.replace(tmp_name, self.fname)
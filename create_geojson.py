@@ -1,19 +1,21 @@
 import os
+import sys
 import argparse
-import time
-import matplotlib.pyplot as plt
 import matplotlib
-import pygrib
 import numpy as np
-from subprocess import Popen
-import subprocess
 from datetime import datetime, timedelta
 from plotconfigs import *
 from mapinfo import *
 import tools
-import geojsoncontour
-import json
-import pandas as pd
+import ingest
+from arrival import ArrivalScheduler
+from accumulation import AccumulationStore
+from membercube import MemberCube
+from checkpoint import Checkpoint
+from manifest import Manifest
+import tiles
+import raster
+from output import OutputPool, contourf_task, spaghetti_task
 
 
 def timestamp(str1, str2):
@@ -22,48 +24,35 @@ def timestamp(str1, str2):
 
     print("%s  %s : %s" % (str1, datetime.strftime(datetime.now(), "%c"), str2))
 
-def get_filesize(fname):
-    """Test filesize on the local system. If the file DNE, return a filsize of 0 bytes.
-
-    Parameters
-    ----------
-    fname : str
-        Location on the local file system to grab filesize for
-
-    Returns
-    -------
-    fsize : int
-        Filsize (bytes)
-    """
-
-    try:
-        fsize = os.stat(fname).st_size
-    except:
-        fsize = 0
-    return fsize
-
-def check_for_file(fname):
-    """Check for file existence on the local system, as well as filesize.
-
-    Parameters
-    ----------
-    fname : str
-        Full path to file
-    """
-
-    fsize = get_filesize(fname)
-    file_exists = os.path.exists(fname)
-    num_attempts = 0
-    while not file_exists and fsize < 50000 and num_attempts < 90:
-        timestamp("[INFO]", "waiting for %s" % (fname))
-        file_exists = os.path.exists(fname)
-        fsize = get_filesize(fname)
-        num_attempts += 1
-        time.sleep(60)
-
 ap = argparse.ArgumentParser()
 ap.add_argument('-r', '--realtime', dest="realtime", help="Number of hours in the past")
 ap.add_argument('-t', '--time-str', dest="time_str", help="YYYY-MM-DD/HH")
+ap.add_argument('-d', '--domain', dest="domain", choices=domains.keys(),
+                help="Crop all processing to a domain in mapinfo.py. Default: full grid")
+ap.add_argument('-f', '--force', dest="force", action="store_true",
+                help="Reprocess forecast hours that are already complete")
+ap.add_argument('-w', '--workers', dest="workers", type=int, default=None,
+                help="Number of GRIB decode processes. Default: one per core")
+ap.add_argument('-e', '--contour-engine', dest="contour_engine", default='native',
+                choices=['native', 'matplotlib'],
+                help="Filled contour engine. Default: native (isobands.py)")
+ap.add_argument('--format', dest="format", default='geojson',
+                choices=['geojson', 'topojson'],
+                help="Product file format. topojson is quantized, simplified and much "
+                     "smaller. Default: geojson")
+ap.add_argument('--simplify', dest="simplify", type=float, default=0.02,
+                help="TopoJSON simplification tolerance in degrees. Default: 0.02")
+ap.add_argument('--tiles', dest="tiles", action="store_true",
+                help="Also cut a z/x/y tile pyramid (zooms %d-%d) for every product" %
+                     tiles.TILE_ZOOMS)
+ap.add_argument('--brotli', dest="brotli", action="store_true",
+                help="Write brotli (.br) copies of products next to the gzip (.gz) ones. "
+                     "Needs the brotli module.")
+ap.add_argument('--raster', dest="raster", type=int, default=None, metavar='SCALE',
+                help="Also write PNG images of the filled-contour products, with SCALE "
+                     "pixels per grid point, for the viewer's image mode")
+ap.add_argument('-o', '--output-workers', dest="output_workers", type=int, default=None,
+                help="Number of contouring/output processes. Default: one per core")
 args = ap.parse_args()
 
 if args.time_str is not None and not args.realtime:
@@ -72,6 +61,9 @@ elif args.realtime:
     target_dt = datetime.utcnow() - timedelta(hours=int(args.realtime))
     date_string = target_dt.strftime('%Y-%m-%d/%H')
 
+# Products are listed in a per-cycle manifest and a top-level index as they are
+# finished, so the viewer never has to scan JSON_DIR.
+manifest = Manifest(JSON_DIR, date_string)
 JSON_DIR = "%s/%s" % (JSON_DIR, date_string)
 if not os.path.exists(JSON_DIR): os.makedirs(JSON_DIR)
 #plot_obj = Plot()
@@ -80,133 +72,141 @@ if not os.path.exists(JSON_DIR): os.makedirs(JSON_DIR)
 #p = PlanView()
 #proj = ccrs.PlateCarree()
 
-fig = plt.figure()
-ax = fig.add_subplot(111)
+# Crop to the requested domain plus an LPMM halo. Everything downstream of the GRIB
+# decode works on the cropped arrays.
+lpmm_delta = 5
+window = (slice(None), slice(None))
+if args.domain is not None:
+    window = tools.get_domain_window(lat, lon, domains[args.domain], halo=lpmm_delta)
+    lat, lon = lat[window], lon[window]
+num_y, num_x = lat.shape
 
 times = np.arange(0, 120+3, 3)
 n_times = times.shape[0]
 
 dir_= "%s/%s" % (DATA_DIR, date_string)
-accum = {}
-accum['3'] = np.zeros((n_perts, n_times, num_y, num_x))
-accum['6'] = np.zeros((n_perts, n_times, num_y, num_x))
-accum['12'] = np.zeros((n_perts, n_times, num_y, num_x))
-accum['24'] = np.zeros((n_perts, n_times, num_y, num_x))
-accum['48'] = np.zeros((n_perts, n_times, num_y, num_x))
-
-snod = {}
-snod['3'] = np.zeros((n_perts, n_times, num_y, num_x))
-snod['total'] = np.zeros((n_perts, n_times, num_y, num_x))
-
-winds = {}
-winds['wspd10m'] = np.zeros((n_perts, n_times, num_y, num_x))
-winds['wgust10m'] = np.zeros((n_perts, n_times, num_y, num_x))
-
-for t in range(0, n_times):
+accum = AccumulationStore(n_perts, times, (num_y, num_x))
+
+# Persisted member cube for this cycle. Only the current hour of snow depth and wind
+# is kept in memory; earlier hours can be read back from the cube.
+cube = MemberCube("%s/%s" % (CUBE_DIR, date_string))
+cube.create(perts, times, lat, lon)
+
+# Hours finished by an earlier run are skipped, with their precipitation totals read
+# back at full precision so later accumulation windows match a clean run.
+checkpoint = Checkpoint("%s/checkpoint.json" % (cube.path),
+                        layout={'domain': args.domain, 'shape': [num_y, num_x],
+                                'format': args.format, 'simplify': args.simplify,
+                                'tiles': args.tiles, 'raster': args.raster,
+                                'contour_engine': args.contour_engine,
+                                'brotli': args.brotli})
+
+decoder = ingest.MemberDecoder(['snod', 'gust', 'apcp'], n_perts, (num_y, num_x), window,
+                               workers=args.workers)
+output = OutputPool(lat, lon, workers=args.output_workers, format=args.format,
+                    simplify=args.simplify,
+                    tiles=tiles.TILE_ZOOMS if args.tiles else None,
+                    compress=('gzip', 'br') if args.brotli else ('gzip',),
+                    raster=args.raster)
+if args.raster:
+    raster.write_bounds("%s/raster_bounds.json" % (JSON_DIR), raster.Resampler(lat, lon))
+engine = args.contour_engine
+
+# Hours are handed out in order as soon as all of their member files have fully
+# arrived, so processing overlaps with the download of later hours.
+files = []
+for hour in times:
+    files.append(["%s/ge%s.t%sz.pgrb2s.0p25.f%s-reduced.grib2" % (dir_, pert,
+                                                                 date_string[-2:],
+                                                                 str(hour).zfill(3))
+                  for pert in perts])
+scheduler = ArrivalScheduler(dir_, files)
+
+for t, fnames in scheduler.hours():
     c1_objects = []
-    p_knt = 0
-    for pert in perts:
-        fname = "%s/ge%s.t%sz.pgrb2s.0p25.f%s-reduced.grib2" % (dir_, pert,
-                                                                date_string[-2:],
-                                                                str(times[t]).zfill(3))
-        check_for_file(fname)
-        timestamp("[INFO]", fname)
-        data = pygrib.open(fname)
-
-        snow_depth = data.select(name="Snow depth")[-1]
-        #u10 = data.select(name="10 metre U wind component")[-1]
-        #v10 = data.select(name="10 metre V wind component")[-1]
-        #wspd10 = np.sqrt(u10.values**2 + v10.values**2)
-        wgust10 = data.select(name="Wind speed (gust)")[-1].values
-        run_date = snow_depth.analDate
-
-        # Derive 3-hourly precipitation at 6-hourly intervals (6, 12, 18, etc.)
-        if t > 0:
-            apcp = data.select(name="Total Precipitation")[-1]
-            idx_start = str(apcp).index('fcst time') + 10
-            idx_end = str(apcp).index('hrs') - 1
-            delta_string = str(apcp)[idx_start:idx_end]
-            idx = delta_string.index('-')
-            delta = int(delta_string[idx+1:]) - int(delta_string[0:idx])
-
-            if delta % 6 == 0:
-                accum['3'][p_knt][t] = (apcp.values * MM2IN) - accum['3'][p_knt][t-1]
-            else:
-                accum['3'][p_knt][t] = apcp.values * MM2IN
-            if t >= 1:
-                accum['6'][p_knt][t] = np.sum(accum['3'][p_knt][t-1:t+1], axis=0)
-            if t >= 2: accum['12'][p_knt][t] = np.sum(accum['3'][p_knt][t-2:t+1], axis=0)
-            if t >= 4: accum['24'][p_knt][t] = np.sum(accum['3'][p_knt][t-4:t+1], axis=0)
-            if t >= 8: accum['48'][p_knt][t] = np.sum(accum['3'][p_knt][t-8:t+1], axis=0)
-
-        # Snow information
-        snod['total'][p_knt][t] = snow_depth.values * M2IN
-
-        # Kinematics
-        #winds['wspd10m'][p_knt][t] = wspd10 * MS2KTS
-        winds['wgust10m'][p_knt][t] = wgust10 * MS2KTS
-        p_knt += 1
-    time_str = str(int(times[t]))
-
-
-    # 3-hr precipitation
-    if t >= 1:
-        data = np.array(accum['3'])
-        lpmm = tools.calc_LPMM(data[:,t])
-    else:
-        lpmm = np.zeros((num_y, num_x))
-    save_name = "%s/qpf_03h_lpmm.f%s" % (JSON_DIR, time_str)
-    contourf = ax.contourf(lon, lat, lpmm, qpf_levs, colors=qpf_cols)
-    geojsoncontour.contourf_to_geojson(contourf=contourf, ndigits=2, geojson_filepath=save_name)
-
-    data = np.array(accum['3'])
-    contourf = ax.contourf(lon, lat, np.max(data[:,t], axis=0), qpf_levs, colors=qpf_cols)
-    save_name = "%s/qpf_03h_max.f%s" % (JSON_DIR, time_str)
-    geojsoncontour.contourf_to_geojson(contourf=contourf, ndigits=2, geojson_filepath=save_name)
-
-    # 6-hr precipitatiom
-    if t >= 1:
-        data = np.array(accum['6'])
-        lpmm = tools.calc_LPMM(data[:,t])
-    else:
-        lpmm = np.zeros((num_y, num_x))
-    save_name = "%s/qpf_06h_lpmm.f%s" % (JSON_DIR, time_str)
-    contourf = ax.contourf(lon, lat, lpmm, qpf_levs, colors=qpf_cols)
-    geojsoncontour.contourf_to_geojson(contourf=contourf, ndigits=2, geojson_filepath=save_name)
-
-    data = np.array(accum['6'])
-    contourf = ax.contourf(lon, lat, np.max(data[:,t], axis=0), qpf_levs, colors=qpf_cols)
-    save_name = "%s/qpf_06h_max.f%s" % (JSON_DIR, time_str)
-    geojsoncontour.contourf_to_geojson(contourf=contourf, ndigits=2, geojson_filepath=save_name)
-
-    # 12-hr precipitatiom
-    if t >= 1:
-        data = np.array(accum['12'])
-        lpmm = tools.calc_LPMM(data[:,t])
-    else:
-        lpmm = np.zeros((num_y, num_x))
-    save_name = "%s/qpf_12h_lpmm.f%s" % (JSON_DIR, time_str)
-    contourf = ax.contourf(lon, lat, lpmm, qpf_levs, colors=qpf_cols)
-    geojsoncontour.contourf_to_geojson(contourf=contourf, ndigits=2, geojson_filepath=save_name)
-
-    data = np.array(accum['12'])
-    contourf = ax.contourf(lon, lat, np.max(data[:,t], axis=0), qpf_levs, colors=qpf_cols)
-    save_name = "%s/qpf_12h_max.f%s" % (JSON_DIR, time_str)
-    geojsoncontour.contourf_to_geojson(contourf=contourf, ndigits=2, geojson_filepath=save_name)
 
+    time_str = str(int(times[t]))
+    total_name = "%s/apcp_total.f%s.npy" % (cube.path, time_str.zfill(3))
+    if not args.force and checkpoint.is_complete(times[t], fnames) and \
+       accum.load(t, total_name):
+        timestamp("[INFO]", "F%s already complete. Skipping" % (time_str.zfill(3)))
+        continue
+
+    # Decode all members for this hour in parallel. There is no precipitation at F000.
+    fields = decoder.fields if t > 0 else [f for f in decoder.fields if f != 'apcp']
+    meta = decoder.decode(fnames, fields=fields)
+    run_date = meta[0]['run_date']
+
+    # Running precipitation totals. Each bucket is added onto the total at the hour it
+    # starts, so 3- and 6-hour buckets need no special handling.
+    if t > 0:
+        accum.add(t, decoder.get('apcp') * MM2IN, [m['apcp_start'] for m in meta])
+    qpf = {hours: accum.window(t, hours) for hours in [3, 6, 12]}
+
+    # Snow information
+    snod_total = decoder.get('snod') * M2IN
+
+    # Kinematics
+    #wspd10 = np.sqrt(decoder.get('u10')**2 + decoder.get('v10')**2)
+    #wspd10m = wspd10 * MS2KTS
+    wgust10m = decoder.get('gust') * MS2KTS
+
+    accum.save(t, total_name)
+    cube.write('apcp', times[t], accum.total[:,t])
+    cube.write('snod', times[t], snod_total)
+    cube.write('gust', times[t], wgust10m)
+
+
+    # LPMM for every field at this hour in one batched call. Fields without any
+    # accumulation yet (e.g. QPF at F000) are all zeros and come back as zeros.
+    stack = np.stack([qpf[3], qpf[6], qpf[12], snod_total, wgust10m])
+    lpmms = tools.calc_LPMM_batch(stack[:,np.newaxis], delta=lpmm_delta)[:,0]
+
+    # Contouring and file output run in the output pool while the next hour decodes
+    tasks = []
+    for i, hours in enumerate([3, 6, 12]):
+        parm = "qpf_%sh" % (str(hours).zfill(2))
+        save_name = "%s/%s_lpmm.f%s" % (JSON_DIR, parm, time_str)
+        tasks.append((contourf_task, (save_name, lpmms[i], qpf_levs, qpf_cols, engine)))
+        save_name = "%s/%s_max.f%s" % (JSON_DIR, parm, time_str)
+        tasks.append((contourf_task, (save_name, np.max(qpf[hours], axis=0), qpf_levs,
+                                      qpf_cols, engine)))
 
     # Total snow depth
-    data = np.array(snod['total'])
-    lpmm = tools.calc_LPMM(data[:,t], delta=5)
+    lpmm = np.where(lpmms[3] >= 0.05, lpmms[3], np.nan)
     save_name = "%s/snod_total_lpmm.f%s" % (JSON_DIR, time_str)
-    lpmm = np.where(lpmm >= 0.05, lpmm, np.nan)
-    contourf = ax.contourf(lon, lat, lpmm, snow_levs, colors=snow_cols)
-    geojsoncontour.contourf_to_geojson(contourf=contourf, ndigits=2, geojson_filepath=save_name)
-
-    data = np.array(snod['total'])
-    contourf = ax.contourf(lon, lat, np.max(data[:,t], axis=0), snow_levs, colors=snow_cols)
+    tasks.append((contourf_task, (save_name, lpmm, snow_levs, snow_cols, engine)))
     save_name = "%s/snod_total_max.f%s" % (JSON_DIR, time_str)
-    geojsoncontour.contourf_to_geojson(contourf=contourf, ndigits=2, geojson_filepath=save_name)
+    tasks.append((contourf_task, (save_name, np.max(snod_total, axis=0), snow_levs,
+                                  snow_cols, engine)))
+
+    # Member minimum and percentiles, all from one sort of the members per field
+    fields = {'qpf_03h': (qpf[3], qpf_levs, qpf_cols),
+              'qpf_06h': (qpf[6], qpf_levs, qpf_cols),
+              'qpf_12h': (qpf[12], qpf_levs, qpf_cols),
+              'snod_total': (snod_total, snow_levs, snow_cols)}
+    for parm, (field, levels, colors) in fields.items():
+        values = tools.calc_percentiles(field, percentiles)
+        for pct, value in zip(percentiles, values):
+            var_type = 'min' if pct == 0 else 'p%s' % (pct)
+            save_name = "%s/%s_%s.f%s" % (JSON_DIR, parm, var_type, time_str)
+            tasks.append((contourf_task, (save_name, value, levels, colors, engine)))
+
+    # 10-m wind gusts
+    save_name = "%s/gust10m_lpmm.f%s" % (JSON_DIR, time_str)
+    tasks.append((contourf_task, (save_name, lpmms[4], gust_levs, gust_cols, engine)))
+    save_name = "%s/gust10m_max.f%s" % (JSON_DIR, time_str)
+    tasks.append((contourf_task, (save_name, np.max(wgust10m, axis=0), gust_levs,
+                                  gust_cols, engine)))
+
+    # Exceedance probabilities. All thresholds of a field come from one pass.
+    fields = {'qpf_03h': qpf[3], 'qpf_06h': qpf[6], 'qpf_12h': qpf[12],
+              'snod_total': snod_total, 'gust10m': wgust10m}
+    for parm, field in fields.items():
+        probs = tools.calc_exceedance_probs(field, prob_thresholds[parm])
+        for thresh, prob in zip(prob_thresholds[parm], probs):
+            save_name = "%s/%s_prob_%g.f%s" % (JSON_DIR, parm, thresh, time_str)
+            tasks.append((contourf_task, (save_name, prob, prob_levs, prob_cols, engine)))
 
     #df = geopandas.read_file(save_name)
     #df_out = df.copy()
@@ -228,25 +228,26 @@ for t in range(0, n_times):
     #if len(df_out) > 0: df_out.to_file(save_name, driver='GeoJSON')
 
 
-    for thresh in [0.10, 0.25, 0.50]:
-        save_name = "%s/qpf_03h_sp_%s.f%s" % (JSON_DIR, str(thresh), time_str)
-        output = dict(features=[], type='FeatureCollection')
-        for i in range(n_perts):
-            #save_name = "%s/qpf_03h_sp_%s.f%s-%s" % (JSON_DIR, str(thresh), time_str, i)
-            plot_data = accum['3'][i][t]
-            contourf = ax.contourf(lon, lat, plot_data, [thresh, 999999])
-            tmp = geojsoncontour.contourf_to_geojson(contourf=contourf, ndigits=2)
-            geojson = json.loads(tmp)
-            for feature in range(len(geojson['features'])):
-                color = matplotlib.colors.to_hex(list(spag_cols[i][0:3]))
-                geojson['features'][feature]['properties'] = {'values': i, 'title': perts[i], 'fill': color}
-                output['features'].append(geojson['features'][feature])
-        with open(save_name, 'w') as f: json.dump(output, f)
-
-    '''
-    for thresh in [0.01, 0.05, 0.10, 0.25, 0.5, 1., 3.]:
-        plot_info = 'Total 6-hour precipitation >= %s"' % (thresh)
-        save_name = "%s/qpf_06h_sp_%s.f%s.png" % (PLOT_DIR, str(thresh), time_str)
-        p.plot_spag(accum['6'][:], t, thresh, run_date, plot_info,
-                             save_name=save_name)
-    '''
+    # Spaghetti contours. Each member is contoured once for all of a field's thresholds.
+    spag_hex = [matplotlib.colors.to_hex(list(color[0:3])) for color in spag_cols]
+    spag_thresholds = [0.10, 0.25, 0.50]
+    for hours in [3, 6, 12]:
+        parm = "qpf_%sh" % (str(hours).zfill(2))
+        save_names = ["%s/%s_sp_%g.f%s" % (JSON_DIR, parm, thresh, time_str)
+                      for thresh in spag_thresholds]
+        tasks.append((spaghetti_task, (save_names, qpf[hours], spag_thresholds, perts,
+                                       spag_hex, engine)))
+
+    output.submit((times[t], fnames), tasks)
+    for (hour, hour_fnames), products in output.finished():
+        checkpoint.mark_complete(hour, hour_fnames, products)
+        manifest.add(products)
+decoder.close()
+for (hour, hour_fnames), products in output.close():
+    checkpoint.mark_complete(hour, hour_fnames, products)
+    manifest.add(products)
+
+# Hours finished so far are checkpointed. A rerun picks up from there.
+if scheduler.timed_out:
+    timestamp("[ERROR]", "Stopped before the last forecast hour arrived")
+    sys.exit(1)
@@ -0,0 +1,125 @@
+import os
+import json
+import mmap
+import pygrib
+
+INDEX_SUFFIX = '.msgidx'
+
+def scan_messages(buf):
+    """Locate every GRIB message in a buffer from the section 0 headers.
+
+    Parameters
+    ----------
+    buf : mmap.mmap or bytes
+        Raw contents of a GRIB file
+
+    Returns
+    -------
+    messages : list
+        (offset, length) in bytes of each message, in file order
+    """
+    messages = []
+    pos = buf.find(b'GRIB', 0)
+    while pos >= 0:
+        edition = buf[pos+7]
+        if edition == 2:
+            length = int.from_bytes(buf[pos+8:pos+16], 'big')
+        else:
+            length = int.from_bytes(buf[pos+4:pos+7], 'big')
+        if length <= 0: break
+        messages.append((pos, length))
+        pos = buf.find(b'GRIB', pos+length)
+    return messages
+
+def build_index(fname):
+    """Build the message index for a GRIB file and save it next to the file.
+
+    The index maps each message name to the byte offset and length of the last message
+    with that name, which is what data.select(name=...)[-1] used to return. The file
+    size and modification time are stored so that a stale index can be detected.
+
+    Parameters
+    ----------
+    fname : str
+        Full path to the GRIB file
+
+    Returns
+    -------
+    index : dict
+    """
+    stat = os.stat(fname)
+    index = {'size': stat.st_size, 'mtime': stat.st_mtime, 'messages': {}}
+    with open(fname, 'rb') as f:
+        buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        for offset, length in scan_messages(buf):
+            grb = pygrib.fromstring(buf[offset:offset+length])
+            index['messages'][grb.name] = [offset, length]
+        buf.close()
+
+    # Write to a temporary file first so readers never see a partial index. A
+    # read-only data directory just means the index is rebuilt next time.
+    tmp_name = "%s%s.tmp%s" % (fname, INDEX_SUFFIX, os.getpid())
+    try:
+        with open(tmp_name, 'w') as f: json.dump(index, f)
+        os.replace(tmp_name, fname + INDEX_SUFFIX)
+    except OSError:
+        pass
+    return index
+
+def load_index(fname):
+    """Load the message index for a GRIB file, rebuilding it if it is missing or the
+    GRIB file has changed since it was written.
+
+    Parameters
+    ----------
+    fname : str
+        Full path to the GRIB file
+
+    Returns
+    -------
+    index : dict
+    """
+    stat = os.stat(fname)
+    try:
+        with open(fname + INDEX_SUFFIX, 'r') as f: index = json.load(f)
+        if index['size'] == stat.st_size and index['mtime'] == stat.st_mtime:
+            return index
+    except (OSError, ValueError, KeyError):
+        pass
+    return build_index(fname)
+
+class GribFile():
+    def __init__(self, fname):
+        """Indexed, memory-mapped GRIB file. Messages are looked up in the sidecar index
+        and only the requested messages are decoded.
+
+        Parameters
+        ----------
+        fname : str
+            Full path to the GRIB file
+        """
+        self.fname = fname
+        self.index = load_index(fname)
+        self._file = open(fname, 'rb')
+        self._buf = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def select(self, name):
+        """Decode the last message in the file with this name.
+
+        Parameters
+        ----------
+        name : str
+            GRIB message name, e.g. 'Snow depth'
+
+        Returns
+        -------
+        grb : pygrib.gribmessage
+        """
+        if name not in self.index['messages']:
+            raise ValueError("No '%s' message in %s" % (name, self.fname))
+        offset, length = self.index['messages'][name]
+        return pygrib.fromstring(self._buf[offset:offset+length])
+
+    def close(self):
+        self._buf.close()
+        self._file.close()
@@ -0,0 +1,123 @@
+import os
+import multiprocessing as mp
+import numpy as np
+import gribindex
+
+# GRIB2 message names for each of the fields we pull out of the member files
+GRIB_NAMES = {
+    'snod': 'Snow depth',
+    'gust': 'Wind speed (gust)',
+    'u10': '10 metre U wind component',
+    'v10': '10 metre V wind component',
+    'apcp': 'Total Precipitation',
+}
+
+# Shared (field, member, y, x) buffer. Set in every worker by _init_worker.
+_cube = None
+
+def _init_worker(buffer, shape):
+    """Attach a pool worker to the shared member cube.
+    """
+    global _cube
+    _cube = np.frombuffer(buffer, dtype=np.float64).reshape(shape)
+
+def _decode_member(args):
+    """Decode the requested fields from one member file straight into the shared cube.
+    Only the small metadata dictionary goes back to the parent process.
+    """
+    member, fname, fields, field_idx, window = args
+    data = gribindex.GribFile(fname)
+    meta = {'member': member, 'run_date': None, 'apcp_start': None}
+    for field in fields:
+        grb = data.select(GRIB_NAMES[field])
+        _cube[field_idx[field], member] = grb.values[window]
+        if meta['run_date'] is None: meta['run_date'] = grb.analDate
+        if field == 'apcp': meta['apcp_start'] = grb['startStep']
+    data.close()
+    return meta
+
+class MemberDecoder():
+    def __init__(self, fields, n_members, shape, window, **kwargs):
+        """Decode all ensemble member files for a forecast hour in a process pool. Each
+        worker writes its decoded fields into a (field, member, y, x) cube held in
+        shared memory, so the grids themselves are never pickled.
+
+        Parameters
+        ----------
+        fields : list
+            Keys of GRIB_NAMES to decode from every member file
+        n_members : int
+            Number of ensemble members
+        shape : tuple
+            (M, N) shape of each field after cropping
+        window : tuple
+            (row slice, column slice) applied to each field right after decode
+
+        Optional Parameters
+        -------------------
+        workers : int
+            Number of decode processes. Default = min(os.cpu_count(), n_members). A
+            value of 1 decodes in the calling process.
+        """
+        self.fields = list(fields)
+        self.field_idx = {field: i for i, field in enumerate(self.fields)}
+        self.window = window
+        self.shape = (len(self.fields), n_members) + tuple(shape)
+
+        self.workers = kwargs.get('workers', None)
+        if self.workers is None: self.workers = min(os.cpu_count() or 1, n_members)
+
+        buffer = mp.RawArray('d', int(np.prod(self.shape)))
+        self.cube = np.frombuffer(buffer, dtype=np.float64).reshape(self.shape)
+        self.pool = None
+        if self.workers > 1:
+            # The producer scripts run at module level, so workers must be forked
+            # rather than spawned (which would re-run the calling script).
+            ctx = mp.get_context('fork')
+            self.pool = ctx.Pool(self.workers, initializer=_init_worker,
+                                 initargs=(buffer, self.shape))
+        else:
+            _init_worker(buffer, self.shape)
+
+    def decode(self, fnames, fields=None):
+        """Decode one forecast hour.
+
+        Parameters
+        ----------
+        fnames : list
+            Member GRIB2 files, in member order
+        fields : list
+            Subset of self.fields to decode for this hour. Fields that are skipped are
+            zeroed in the cube. Default = all fields.
+
+        Returns
+        -------
+        meta : list
+            One dictionary per member with the run_date (analysis time) and the
+            apcp_start forecast hour the precipitation bucket starts at (None if apcp
+            was not decoded)
+        """
+        if fields is None: fields = self.fields
+        for field in self.fields:
+            if field not in fields: self.cube[self.field_idx[field]] = 0.
+
+        tasks = [(member, fname, fields, self.field_idx, self.window)
+                 for member, fname in enumerate(fnames)]
+        if self.pool is not None:
+            meta = self.pool.map(_decode_member, tasks, chunksize=1)
+        else:
+            meta = [_decode_member(task) for task in tasks]
+        return meta
+
+    def get(self, field):
+        """(member, y, x) view of one decoded field in the shared cube.
+        """
+        return self.cube[self.field_idx[field]]
+
+    def close(self):
+        """Shut down the worker pool.
+        """
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
@@ -0,0 +1,497 @@
+"""
+Filled contours (isobands) straight from a 2-D grid to GeoJSON, without going through
+matplotlib. Every grid cell is split into two triangles and the part of each triangle
+that falls inside a band is cut out exactly, assuming values vary linearly across the
+triangle. Edges shared by neighbouring pieces cancel, and what is left is linked into
+rings: counter-clockwise outer rings and clockwise holes.
+
+As with matplotlib's contourf, band i covers levels[i] < z <= levels[i+1], and only
+the lowest band also includes its lower level. A plateau exactly on a level is
+therefore drawn in one band rather than as overlapping polygons in two.
+"""
+import json
+from numba import njit
+import numpy as np
+
+@njit(nogil=True)
+def _edge_key(j0, i0, j1, i1, nx, n_cells, which):
+    """Integer key for a point on the grid edge between nodes (j0, i0) and (j1, i1).
+    Points that sit on the same edge at the same level get the same key in every
+    piece, which is what lets shared edges cancel.
+    """
+    if j1 < j0 or (j1 == j0 and i1 < i0):
+        j0, i0, j1, i1 = j1, i1, j0, i0
+    if j0 == j1:
+        kind = 1
+    elif i0 == i1:
+        kind = 2
+    else:
+        kind = 3
+    return ((kind * n_cells) + j0*nx + i0) * 2 + which
+
+@njit(nogil=True)
+def _emit(pk, px, py, n_pts, n, fill, out_a, out_b, out_x, out_y):
+    """Write the edges of one convex piece. Degenerate pieces are dropped.
+    """
+    if n_pts < 3: return n
+    area = 0.
+    for k in range(n_pts):
+        k1 = (k + 1) % n_pts
+        area += px[k]*py[k1] - px[k1]*py[k]
+    if abs(area) < 1e-12: return n
+    for k in range(n_pts):
+        if fill:
+            out_a[n] = pk[k]
+            out_b[n] = pk[(k + 1) % n_pts]
+            out_x[n] = px[k]
+            out_y[n] = py[k]
+        n += 1
+    return n
+
+@njit(nogil=True)
+def _crossing(x, y, jp, ip, jq, iq, t, which, nx, n_cells, pk, px, py, n_pts):
+    """Add the point a fraction t of the way along the edge p -> q to a piece.
+    """
+    pk[n_pts] = _edge_key(jp, ip, jq, iq, nx, n_cells, which)
+    px[n_pts] = x[jp,ip] + t * (x[jq,iq] - x[jp,ip])
+    py[n_pts] = y[jp,ip] + t * (y[jq,iq] - y[jp,ip])
+    return n_pts + 1
+
+@njit(nogil=True)
+def _triangle(z, x, y, js, is_, lo, hi, closed, nx, n_cells, n, fill, out_a, out_b,
+              out_x, out_y, pk, px, py):
+    """Clip one triangle to lo <= z <= hi. The corners are given counter-clockwise in
+    index space, so the clipped piece is too. Unless the band is closed at lo, a
+    triangle that never rises above lo is left out.
+    """
+    if not closed and max(max(z[js[0],is_[0]], z[js[1],is_[1]]), z[js[2],is_[2]]) <= lo:
+        return n
+    n_pts = 0
+    for e in range(3):
+        jp, ip = js[e], is_[e]
+        jq, iq = js[(e + 1) % 3], is_[(e + 1) % 3]
+        vp, vq = z[jp,ip], z[jq,iq]
+        if vp >= lo and vp <= hi:
+            pk[n_pts] = ((jp*nx) + ip) * 2
+            px[n_pts] = x[jp,ip]
+            py[n_pts] = y[jp,ip]
+            n_pts += 1
+
+        # Level crossings along p -> q, in the order they are met
+        t_lo = -1.
+        t_hi = -1.
+        if (vp - lo) * (vq - lo) < 0: t_lo = (lo - vp) / (vq - vp)
+        if (vp - hi) * (vq - hi) < 0: t_hi = (hi - vp) / (vq - vp)
+        if t_lo >= 0 and t_hi >= 0 and t_hi < t_lo:
+            n_pts = _crossing(x, y, jp, ip, jq, iq, t_hi, 1, nx, n_cells, pk, px, py,
+                              n_pts)
+            n_pts = _crossing(x, y, jp, ip, jq, iq, t_lo, 0, nx, n_cells, pk, px, py,
+                              n_pts)
+        else:
+            if t_lo >= 0:
+                n_pts = _crossing(x, y, jp, ip, jq, iq, t_lo, 0, nx, n_cells, pk, px, py,
+                                  n_pts)
+            if t_hi >= 0:
+                n_pts = _crossing(x, y, jp, ip, jq, iq, t_hi, 1, nx, n_cells, pk, px, py,
+                                  n_pts)
+    return _emit(pk, px, py, n_pts, n, fill, out_a, out_b, out_x, out_y)
+
+@njit(nogil=True)
+def _whole_cell(z, j, i, lo, hi, closed):
+    """True if grid cell (j, i) exists and lies entirely inside lo <= z <= hi (or
+    lo < z <= hi if the band is not closed at lo).
+    """
+    ny, nx = z.shape
+    if j < 0 or i < 0 or j >= ny-1 or i >= nx-1: return False
+    for jj in range(j, j+2):
+        for ii in range(i, i+2):
+            v = z[jj,ii]
+            if not ((v > lo or (closed and v == lo)) and v <= hi): return False
+    return True
+
+@njit(nogil=True)
+def _band_edges(z, x, y, lo, hi, closed, cells, fill, out_a, out_b, out_x, out_y):
+    """Edges of every piece of the band lo < z <= hi (lo <= z <= hi if closed), looking
+    only at the given cells (flat indices into the (M-1)x(N-1) cells, in order). With
+    fill=False the edges are only counted, so the output arrays can be sized exactly.
+    """
+    ny, nx = z.shape
+    n_cells = ny * nx
+    pk = np.empty(8, dtype=np.int64)
+    px = np.empty(8)
+    py = np.empty(8)
+    js = np.empty(3, dtype=np.int64)
+    is_ = np.empty(3, dtype=np.int64)
+    n = 0
+    for c in cells:
+        j = c // (nx-1)
+        i = c - j * (nx-1)
+        z00, z01, z10, z11 = z[j,i], z[j,i+1], z[j+1,i], z[j+1,i+1]
+        if np.isnan(z00) or np.isnan(z01) or np.isnan(z10) or np.isnan(z11):
+            continue
+        zmin = min(min(z00, z01), min(z10, z11))
+        zmax = max(max(z00, z01), max(z10, z11))
+        if zmax < lo or zmin > hi or (zmax == lo and not closed): continue
+
+        # Whole cell inside the band: one quad, no diagonal. A side shared with
+        # another whole cell would only cancel, so it is left out. That keeps the
+        # edge count down to the band's outline instead of its area.
+        if (zmin > lo or (closed and zmin == lo)) and zmax <= hi:
+            n_pts = 0
+            for jj, ii in ((j, i), (j, i+1), (j+1, i+1), (j+1, i)):
+                pk[n_pts] = ((jj*nx) + ii) * 2
+                px[n_pts] = x[jj,ii]
+                py[n_pts] = y[jj,ii]
+                n_pts += 1
+            for k in range(4):
+                if k == 0: inner = _whole_cell(z, j-1, i, lo, hi, closed)
+                elif k == 1: inner = _whole_cell(z, j, i+1, lo, hi, closed)
+                elif k == 2: inner = _whole_cell(z, j+1, i, lo, hi, closed)
+                else: inner = _whole_cell(z, j, i-1, lo, hi, closed)
+                if inner: continue
+                if fill:
+                    out_a[n] = pk[k]
+                    out_b[n] = pk[(k + 1) % 4]
+                    out_x[n] = px[k]
+                    out_y[n] = py[k]
+                n += 1
+            continue
+
+        js[0], is_[0], js[1], is_[1], js[2], is_[2] = j, i, j, i+1, j+1, i+1
+        n = _triangle(z, x, y, js, is_, lo, hi, closed, nx, n_cells, n, fill, out_a,
+                      out_b, out_x, out_y, pk, px, py)
+        js[0], is_[0], js[1], is_[1], js[2], is_[2] = j, i, j+1, i+1, j+1, i
+        n = _triangle(z, x, y, js, is_, lo, hi, closed, nx, n_cells, n, fill, out_a,
+                      out_b, out_x, out_y, pk, px, py)
+    return n
+
+@njit(nogil=True)
+def _link_rings(a, b):
+    """Chain boundary edges (sorted by start key) into closed rings.
+
+    Returns
+    -------
+    order : np.array
+        Edge indices, ring after ring
+    starts : np.array
+        Offsets of each ring in order, plus the total length
+    """
+    n = a.shape[0]
+    used = np.zeros(n, dtype=np.bool_)
+    order = np.empty(n, dtype=np.int64)
+    starts = np.empty(n+1, dtype=np.int64)
+    n_rings = 0
+    knt = 0
+    for first in range(n):
+        if used[first]: continue
+        starts[n_rings] = knt
+        n_rings += 1
+        e = first
+        while not used[e]:
+            used[e] = True
+            order[knt] = e
+            knt += 1
+            # Next unused edge that starts where this one ends
+            nxt = np.searchsorted(a, b[e])
+            while nxt < n and a[nxt] == b[e] and used[nxt]: nxt += 1
+            if nxt >= n or a[nxt] != b[e]: break
+            e = nxt
+    starts[n_rings] = knt
+    return order[:knt], starts[:n_rings+1]
+
+@njit(nogil=True)
+def _clean_rings(ex, ey, ek, n_cells, starts, flip, scale):
+    """Round each ring (if scale > 0), reverse it if flip is set, then drop repeated and
+    collinear vertices and rings with fewer than three vertices left. Crossings of the
+    cell diagonals are dropped as well, leaving one segment per cell crossed, as in
+    marching squares.
+
+    Returns
+    -------
+    x, y : np.array
+        Ring vertices, ring after ring (not closed)
+    new_starts : np.array
+        Offsets of each ring in x and y, plus the total length
+    areas : np.array
+        Signed area of each ring. Positive for counter-clockwise.
+    """
+    n = ex.shape[0]
+    x = np.empty(n)
+    y = np.empty(n)
+    tx = np.empty(n)
+    ty = np.empty(n)
+    new_starts = np.empty(starts.shape[0], dtype=np.int64)
+    areas = np.empty(starts.shape[0]-1)
+    n_rings = 0
+    knt = 0
+    for r in range(starts.shape[0]-1):
+        s0, s1 = starts[r], starts[r+1]
+        m = 0
+        for k in range(s1 - s0):
+            src = s1 - 1 - k if flip else s0 + k
+            if (ek[src] // 2) // n_cells == 3: continue
+            vx, vy = ex[src], ey[src]
+            if scale > 0:
+                vx = np.rint(vx * scale) / scale
+                vy = np.rint(vy * scale) / scale
+            if m > 0 and vx == tx[m-1] and vy == ty[m-1]: continue
+            tx[m] = vx
+            ty[m] = vy
+            m += 1
+        while m > 1 and tx[m-1] == tx[0] and ty[m-1] == ty[0]: m -= 1
+        if m < 3: continue
+
+        start = knt
+        for k in range(m):
+            kp = (k - 1) % m
+            kn = (k + 1) % m
+            cross = (tx[k] - tx[kp]) * (ty[kn] - ty[kp]) - \
+                    (tx[kn] - tx[kp]) * (ty[k] - ty[kp])
+            if cross == 0: continue
+            x[knt] = tx[k]
+            y[knt] = ty[k]
+            knt += 1
+        if knt - start < 3:
+            knt = start
+            continue
+
+        area = 0.
+        for k in range(start, knt):
+            k1 = k + 1 if k + 1 < knt else start
+            area += x[k]*y[k1] - x[k1]*y[k]
+        new_starts[n_rings] = start
+        areas[n_rings] = 0.5 * area
+        n_rings += 1
+    new_starts[n_rings] = knt
+    return x[:knt], y[:knt], new_starts[:n_rings+1], areas[:n_rings]
+
+@njit(nogil=True)
+def _contains(x, y, s0, s1, px, py):
+    """Ray-casting point in polygon test against the ring x[s0:s1], y[s0:s1].
+    """
+    inside = False
+    for k in range(s0, s1):
+        k1 = k + 1 if k + 1 < s1 else s0
+        if (y[k] > py) != (y[k1] > py):
+            x_int = x[k] + (py - y[k]) * (x[k1] - x[k]) / (y[k1] - y[k])
+            if px < x_int: inside = not inside
+    return inside
+
+@njit(nogil=True)
+def _assign_holes(x, y, starts, areas):
+    """Find the smallest outer ring containing each hole.
+
+    Returns
+    -------
+    parent : np.array
+        For each hole, the index of its outer ring (-1 if none was found). -1 for
+        every outer ring.
+    """
+    n_rings = areas.shape[0]
+    parent = np.full(n_rings, -1, dtype=np.int64)
+    bbox = np.empty((n_rings, 4))
+    for r in range(n_rings):
+        s0, s1 = starts[r], starts[r+1]
+        bbox[r,0] = x[s0:s1].min()
+        bbox[r,1] = x[s0:s1].max()
+        bbox[r,2] = y[s0:s1].min()
+        bbox[r,3] = y[s0:s1].max()
+    for h in range(n_rings):
+        if areas[h] >= 0: continue
+        s = starts[h]
+        px, py = x[s], y[s]
+        if starts[h+1] - s == 3:
+            px = (x[s] + x[s+1] + x[s+2]) / 3.
+            py = (y[s] + y[s+1] + y[s+2]) / 3.
+        for r in range(n_rings):
+            if areas[r] <= 0: continue
+            if px < bbox[r,0] or px > bbox[r,1] or py < bbox[r,2] or py > bbox[r,3]:
+                continue
+            if parent[h] >= 0 and areas[r] >= areas[parent[h]]: continue
+            if _contains(x, y, starts[r], starts[r+1], px, py): parent[h] = r
+    return parent
+
+def _cell_ranges(z):
+    """Minimum and maximum of the four corners of every grid cell, flattened. NaN for
+    cells with a NaN corner, so they never fall inside a band.
+    """
+    corners = (z[:-1,:-1], z[:-1,1:], z[1:,:-1], z[1:,1:])
+    return np.minimum.reduce(corners).ravel(), np.maximum.reduce(corners).ravel()
+
+def _band_cells(ranges, lo, hi):
+    """Cells that reach into lo <= z <= hi.
+    """
+    cell_min, cell_max = ranges
+    return np.flatnonzero((cell_max >= lo) & (cell_min <= hi))
+
+def band_polygons(data, lat, lon, lo, hi, ndigits=2, closed=True):
+    """Polygons covering lo <= data <= hi, or lo < data <= hi if closed is False.
+
+    Parameters
+    ----------
+    data : np.array
+        Grid to contour (MxN). NaN points are left out.
+    lat : np.array
+        Latitudes (MxN)
+    lon : np.array
+        Longitudes (MxN)
+    lo : float
+        Lower bound of the band
+    hi : float
+        Upper bound of the band
+    ndigits : int
+        Decimal places to round coordinates to. Default = 2
+    closed : bool
+        Include points equal to lo. Default = True
+
+    Returns
+    -------
+    polygons : list
+        GeoJSON MultiPolygon coordinates: a list of [outer ring, hole, hole, ...]
+    """
+    z = np.ascontiguousarray(data, dtype=np.float64)
+    x = np.ascontiguousarray(lon, dtype=np.float64)
+    y = np.ascontiguousarray(lat, dtype=np.float64)
+    return _band_polygons(z, x, y, lo, hi, _band_cells(_cell_ranges(z), lo, hi), ndigits,
+                          closed)
+
+def _band_polygons(z, x, y, lo, hi, cells, ndigits, closed=True):
+    """band_polygons on contiguous float64 grids, for the cells given.
+    """
+    if cells.size == 0: return []
+    empty_i = np.empty(0, dtype=np.int64)
+    empty_f = np.empty(0)
+    n = _band_edges(z, x, y, lo, hi, closed, cells, False, empty_i, empty_i, empty_f,
+                    empty_f)
+    if n == 0: return []
+    a = np.empty(n, dtype=np.int64)
+    b = np.empty(n, dtype=np.int64)
+    ex = np.empty(n)
+    ey = np.empty(n)
+    _band_edges(z, x, y, lo, hi, closed, cells, True, a, b, ex, ey)
+
+    # Interior edges appear once in each direction and cancel
+    lo_key = np.minimum(a, b)
+    hi_key = np.maximum(a, b)
+    idx = np.lexsort((hi_key, lo_key))
+    same = (lo_key[idx][1:] == lo_key[idx][:-1]) & (hi_key[idx][1:] == hi_key[idx][:-1])
+    dup = np.zeros(n, dtype=bool)
+    dup[:-1] |= same
+    dup[1:] |= same
+    idx = idx[~dup]
+    if idx.size == 0: return []
+    idx = idx[np.argsort(a[idx], kind='stable')]
+    order, starts = _link_rings(a[idx], b[idx])
+    ex, ey, ek = ex[idx][order], ey[idx][order], a[idx][order]
+
+    # Pieces are counter-clockwise in index space. Flip if the grid's lon/lat axes
+    # reverse that, so that outer rings come out counter-clockwise.
+    flip = ((x[0,1] - x[0,0]) * (y[1,1] - y[0,0]) -
+            (x[1,1] - x[0,0]) * (y[0,1] - y[0,0])) < 0
+    scale = 10.**ndigits if ndigits is not None else 0.
+    rx, ry, starts, areas = _clean_rings(ex, ey, ek, z.size, starts, flip, scale)
+    parent = _assign_holes(rx, ry, starts, areas)
+
+    coords = np.column_stack((rx, ry)).tolist()
+    polygons = []
+    outer_idx = {}
+    for r in np.flatnonzero(areas > 0):
+        outer_idx[r] = len(polygons)
+        polygons.append([coords[starts[r]:starts[r+1]] + [coords[starts[r]]]])
+    for h in np.flatnonzero(parent >= 0):
+        ring = coords[starts[h]:starts[h+1]] + [coords[starts[h]]]
+        polygons[outer_idx[parent[h]]].append(ring)
+    return polygons
+
+def exceedance_polygons(data, lat, lon, thresholds, ndigits=2):
+    """Polygons covering data >= each of several thresholds. The cell ranges are worked
+    out once for the grid, and each threshold then only visits the cells that reach
+    it, so extra thresholds cost little more than their outlines.
+
+    Parameters
+    ----------
+    data : np.array
+        Grid to contour (MxN). NaN points are left out.
+    lat : np.array
+        Latitudes (MxN)
+    lon : np.array
+        Longitudes (MxN)
+    thresholds : list
+        Lower bounds of the exceedance areas
+    ndigits : int
+        Decimal places to round coordinates to. Default = 2
+
+    Returns
+    -------
+    polygons : list
+        GeoJSON MultiPolygon coordinates for each threshold, as from band_polygons
+    """
+    z = np.ascontiguousarray(data, dtype=np.float64)
+    x = np.ascontiguousarray(lon, dtype=np.float64)
+    y = np.ascontiguousarray(lat, dtype=np.float64)
+    ranges = _cell_ranges(z)
+    return [_band_polygons(z, x, y, thresh, np.inf, _band_cells(ranges, thresh, np.inf),
+                           ndigits) for thresh in thresholds]
+
+def isobands_to_geojson(data, lat, lon, levels, colors, ndigits=2, geojson_filepath=None,
+                        **kwargs):
+    """Filled contours of a grid as a GeoJSON FeatureCollection. Feature properties
+    follow geojsoncontour.contourf_to_geojson, plus a 'values' entry holding the upper
+    level of each band.
+
+    Parameters
+    ----------
+    data : np.array
+        Grid to contour (MxN)
+    lat : np.array
+        Latitudes (MxN)
+    lon : np.array
+        Longitudes (MxN)
+    levels : list
+        Contour levels. Band i covers levels[i] < z <= levels[i+1]. The lowest band
+        also includes levels[0].
+    colors : list
+        Fill colors (hex), one per band
+    ndigits : int
+        Decimal places to round coordinates to. Default = 2
+    geojson_filepath : str
+        If given, the FeatureCollection is also written to this file
+
+    Optional Parameters
+    -------------------
+    stroke_width : float
+        Default = 1
+    fill_opacity : float
+        Default = 0.9
+
+    Returns
+    -------
+    geojson : dict
+    """
+    stroke_width = kwargs.get('stroke_width', 1)
+    fill_opacity = kwargs.get('fill_opacity', .9)
+    z = np.ascontiguousarray(data, dtype=np.float64)
+    x = np.ascontiguousarray(lon, dtype=np.float64)
+    y = np.ascontiguousarray(lat, dtype=np.float64)
+    ranges = _cell_ranges(z)
+    features = []
+    for k in range(len(levels)-1):
+        lo, hi = levels[k], levels[k+1]
+        polygons = _band_polygons(z, x, y, lo, hi, _band_cells(ranges, lo, hi), ndigits,
+                                  closed=(k == 0))
+        if not polygons: continue
+        properties = {
+            'stroke': colors[k],
+            'stroke-width': stroke_width,
+            'stroke-opacity': 1,
+            'fill': colors[k],
+            'fill-opacity': fill_opacity,
+            'title': "%.2f-%.2f " % (levels[k], levels[k+1]),
+            'values': float(levels[k+1]),
+        }
+        features.append({'type': 'Feature', 'properties': properties,
+                         'geometry': {'type': 'MultiPolygon', 'coordinates': polygons}})
+    geojson = {'type': 'FeatureCollection', 'features': features}
+    if geojson_filepath is not None:
+        with open(geojson_filepath, 'w') as f: f.write(json.dumps(geojson))
+    return geojson
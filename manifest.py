@@ -0,0 +1,154 @@
+"""
+Product manifests, so the viewer can find cycles and products without scanning
+JSON_DIR.
+
+    <JSON_DIR>/<YYYY-MM-DD>/<HH>/manifest.json
+        {'cycle': 'YYYY-MM-DD/HH', 'products': {name: {hour: {'size', 'sha1'}}}}
+    <JSON_DIR>/index.json
+        {'cycles': {'YYYY-MM-DD/HH': {'products': n, 'hours': [...], 'updated': t}}}
+
+Both files are replaced atomically, so readers never see a partial write.
+"""
+import os
+import json
+import time
+import hashlib
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+MANIFEST = 'manifest.json'
+INDEX = 'index.json'
+
+def _atomic_write(fname, data):
+    tmp_name = "%s.%d.tmp" % (fname, os.getpid())
+    with open(tmp_name, 'w') as f: json.dump(data, f)
+    os.replace(tmp_name, fname)
+
+def _sha1(fname):
+    digest = hashlib.sha1()
+    with open(fname, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''): digest.update(block)
+    return digest.hexdigest()
+
+def split_product(fname):
+    """Product name and forecast hour of a product file, e.g.
+    '/json/2021-01-01/00/qpf_03h_lpmm.f12' -> ('qpf_03h_lpmm', 12).
+    """
+    name, hour = os.path.basename(fname).rsplit('.f', 1)
+    return name, int(hour)
+
+class Manifest():
+    def __init__(self, json_dir, cycle_str):
+        """Manifest of one model cycle's products.
+
+        Parameters
+        ----------
+        json_dir : str
+            Top-level product directory (JSON_DIR)
+        cycle_str : str
+            YYYY-MM-DD/HH
+        """
+        self.json_dir = json_dir
+        self.cycle_str = cycle_str
+        self.fname = "%s/%s/%s" % (json_dir, cycle_str, MANIFEST)
+        self.state = {'cycle': cycle_str, 'products': {}}
+        try:
+            with open(self.fname, 'r') as f: self.state = json.load(f)
+        except (OSError, ValueError):
+            pass
+
+    def add(self, products):
+        """Record finished product files, then save the manifest and update the
+        top-level index.
+
+        Parameters
+        ----------
+        products : list
+            Product files (<JSON_DIR>/<cycle>/<name>.fNNN)
+        """
+        for fname in products:
+            name, hour = split_product(fname)
+            self.state['products'].setdefault(name, {})[str(hour)] = {
+                'size': os.path.getsize(fname),
+                'sha1': _sha1(fname),
+            }
+        _atomic_write(self.fname, self.state)
+
+        hours = set()
+        for entry in self.state['products'].values(): hours.update(entry.keys())
+        update_index(self.json_dir, self.cycle_str, {
+            'products': len(self.state['products']),
+            'hours': sorted(int(hour) for hour in hours),
+            'updated': time.time(),
+        })
+
+def update_index(json_dir, cycle_str, summary):
+    """Add or replace one cycle in the top-level index. Serialized with a lock file
+    where fcntl is available, in case several cycles are being produced at once.
+    """
+    index_name = "%s/%s" % (json_dir, INDEX)
+    with open(index_name + '.lock', 'w') as lock:
+        if fcntl is not None: fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            with open(index_name, 'r') as f: index = json.load(f)
+        except (OSError, ValueError):
+            index = {'cycles': {}}
+        index['cycles'][cycle_str] = summary
+        _atomic_write(index_name, index)
+
+class ManifestIndex():
+    def __init__(self, json_dir):
+        """The top-level index, as read by the viewer. It is re-read only when its
+        modification time changes, so lookups stay cheap however many cycles are kept.
+
+        Parameters
+        ----------
+        json_dir : str
+            Top-level product directory (JSON_DIR)
+        """
+        self.fname = "%s/%s" % (json_dir, INDEX)
+        self.mtime = None
+        self.cycles = {}
+
+    def refresh(self):
+        """Cycles in the index, re-read if the file changed.
+
+        Returns
+        -------
+        cycles : dict
+            Summary of each cycle, keyed by YYYY-MM-DD/HH. Empty if there is no index.
+        """
+        try:
+            mtime = os.stat(self.fname).st_mtime_ns
+        except OSError:
+            return {}
+        if mtime != self.mtime:
+            try:
+                with open(self.fname, 'r') as f: self.cycles = json.load(f)['cycles']
+            except (OSError, ValueError, KeyError):
+                return self.cycles
+            self.mtime = mtime
+        return self.cycles
+
+def rebuild(json_dir):
+    """Write manifests and the index for every cycle already under json_dir, e.g.
+    products made before manifests existed.
+    """
+    for day in sorted(os.listdir(json_dir)):
+        if not os.path.isdir("%s/%s" % (json_dir, day)): continue
+        for hour in sorted(os.listdir("%s/%s" % (json_dir, day))):
+            cycle_dir = "%s/%s/%s" % (json_dir, day, hour)
+            if not os.path.isdir(cycle_dir): continue
+            products = []
+            for name in os.listdir(cycle_dir):
+                suffix = name.rsplit('.f', 1)[-1]
+                if '.f' in name and suffix.isdigit():
+                    products.append("%s/%s" % (cycle_dir, name))
+            if products: Manifest(json_dir, "%s/%s" % (day, hour)).add(products)
+
+if __name__ == '__main__':
+    from plotconfigs import JSON_DIR
+    rebuild(JSON_DIR)
@@ -0,0 +1,173 @@
+import os
+import json
+from glob import glob
+import numpy as np
+
+# Variables kept in the cube. Values are stored as uint16 counts of `scale` so each
+# (variable, hour) chunk is a quarter of the float64 size and can still be memory
+# mapped. MISSING marks masked or out-of-range points.
+CUBE_VARIABLES = {
+    'apcp': {'scale': 0.001, 'units': 'in', 'long_name': 'Total precipitation since F000'},
+    'snod': {'scale': 0.01, 'units': 'in', 'long_name': 'Snow depth'},
+    'gust': {'scale': 0.01, 'units': 'kt', 'long_name': '10-m wind gust'},
+}
+MISSING = 65535
+
+def quantize(data, scale):
+    """Convert a float field to uint16 counts of scale. Negative, non-finite and
+    out-of-range values are set to MISSING.
+    """
+    counts = np.round(np.asarray(data, dtype=np.float64) / scale)
+    good = np.isfinite(counts) & (counts >= 0) & (counts < MISSING)
+    return np.where(good, counts, MISSING).astype(np.uint16)
+
+def dequantize(counts, scale):
+    """Convert uint16 counts back to float32 values, with MISSING set to NaN.
+    """
+    values = counts.astype(np.float32) * np.float32(scale)
+    values[counts == MISSING] = np.nan
+    return values
+
+class MemberCube():
+    def __init__(self, path):
+        """Per-cycle store of every ensemble member field on disk. Each (variable,
+        forecast hour) is its own (member, y, x) chunk, so one hour or one member slice
+        can be read through a memory map without touching the rest of the cycle.
+
+        Parameters
+        ----------
+        path : str
+            Directory holding the cube for one model cycle
+        """
+        self.path = path
+        self.meta = None
+        meta_file = "%s/cube.json" % (path)
+        if os.path.exists(meta_file):
+            with open(meta_file, 'r') as f: self.meta = json.load(f)
+
+    def create(self, members, times, lat, lon):
+        """Set up a new cube, or reopen an existing one with the same layout. A cube
+        written for other members, forecast hours or grid (e.g. another domain) is
+        discarded: every array in the directory is removed before the new layout is
+        saved.
+
+        Parameters
+        ----------
+        members : list
+            Member names, in the order they are stored
+        times : np.array
+            Forecast hours of the cycle
+        lat : np.array
+            Latitudes of the (possibly cropped) grid (MxN)
+        lon : np.array
+            Longitudes of the (possibly cropped) grid (MxN)
+        """
+        if not os.path.exists(self.path): os.makedirs(self.path)
+        meta = {
+            'members': list(members),
+            'times': [int(hour) for hour in times],
+            'shape': list(lat.shape),
+            'variables': CUBE_VARIABLES,
+        }
+        latlon = np.stack([lat, lon]).astype(np.float32)
+        if self.meta is not None and not self._same_layout(meta, latlon):
+            for fname in glob("%s/*.npy" % (self.path)): os.remove(fname)
+        self.meta = meta
+        self._save("%s/latlon.npy" % (self.path), latlon)
+        tmp_name = "%s/cube.json.tmp" % (self.path)
+        with open(tmp_name, 'w') as f: json.dump(self.meta, f)
+        os.replace(tmp_name, "%s/cube.json" % (self.path))
+
+    def _same_layout(self, meta, latlon):
+        """Whether the cube on disk was written with this layout and grid.
+        """
+        if any(self.meta.get(key) != meta[key] for key in meta): return False
+        try:
+            return np.array_equal(self.latlon(), latlon)
+        except (OSError, ValueError):
+            return False
+
+    def chunk_name(self, var, hour):
+        return "%s/%s.f%s.npy" % (self.path, var, str(int(hour)).zfill(3))
+
+    def write(self, var, hour, data):
+        """Quantize and save one (member, y, x) chunk.
+
+        Parameters
+        ----------
+        var : str
+            Key of CUBE_VARIABLES
+        hour : int
+            Forecast hour
+        data : np.array
+            Member values for this hour (PxMxN), in CUBE_VARIABLES units
+        """
+        scale = self.meta['variables'][var]['scale']
+        self._save(self.chunk_name(var, hour), quantize(data, scale))
+
+    def read(self, var, hour, members=slice(None)):
+        """Read one forecast hour of a variable. Only the requested members are pulled
+        from the memory-mapped chunk.
+
+        Parameters
+        ----------
+        var : str
+            Key of CUBE_VARIABLES
+        hour : int
+            Forecast hour
+        members : int, slice or list
+            Members to read. Default = all members
+
+        Returns
+        -------
+        values : np.array
+            float32 values (PxMxN, or MxN for a single member). Missing points are NaN.
+        """
+        counts = np.load(self.chunk_name(var, hour), mmap_mode='r')
+        return dequantize(np.asarray(counts[members]), self.meta['variables'][var]['scale'])
+
+    def read_point(self, var, j, i, hours=None):
+        """Every member's value at one grid point, for a run of forecast hours. Only
+        the pages holding that point are read from each memory-mapped chunk.
+
+        Parameters
+        ----------
+        var : str
+            Key of CUBE_VARIABLES
+        j : int
+            Row of the (possibly cropped) grid
+        i : int
+            Column of the (possibly cropped) grid
+        hours : list
+            Forecast hours to read. Default = every hour in the cube. Hours that have
+            not been written yet are skipped.
+
+        Returns
+        -------
+        hours : list
+            Forecast hours read
+        values : np.array
+            float32 values (PxT). Missing points are NaN.
+        """
+        if hours is None: hours = self.meta['times']
+        hours = [hour for hour in hours if self.has(var, hour)]
+        counts = np.empty((len(self.meta['members']), len(hours)), dtype=np.uint16)
+        for t, hour in enumerate(hours):
+            counts[:,t] = np.load(self.chunk_name(var, hour), mmap_mode='r')[:, j, i]
+        return hours, dequantize(counts, self.meta['variables'][var]['scale'])
+
+    def latlon(self):
+        """Memory-mapped (2, M, N) array of the grid latitudes and longitudes.
+        """
+        return np.load("%s/latlon.npy" % (self.path), mmap_mode='r')
+
+    def has(self, var, hour):
+        return os.path.exists(self.chunk_name(var, hour))
+
+    def _save(self, fname, array):
+        """Write an array to a temporary file and move it into place, so readers never
+        see a partially written chunk.
+        """
+        tmp_name = fname[:-4] + '.tmp.npy'
+        np.save(tmp_name, array)
+        os.replace(tmp_name, fname)
@@ -0,0 +1,282 @@
+import os
+import json
+import multiprocessing as mp
+from concurrent.futures import ThreadPoolExecutor
+from matplotlib.figure import Figure
+import geojsoncontour
+import isobands
+import topology
+import tiles
+import precompress
+import raster
+
+# Worker-local plotting state. Set in every worker by _init_worker.
+_state = {}
+
+def _init_worker(lat, lon, encoding):
+    """Give each output worker its own figure and axes to contour on.
+    """
+    fig = Figure()
+    _state['ax'] = fig.add_subplot(111)
+    _state['lat'] = lat
+    _state['lon'] = lon
+    _state['encoding'] = encoding
+    if encoding['raster']:
+        _state['resampler'] = raster.Resampler(lat, lon, scale=encoding['raster'])
+
+def _write(save_name, geojson):
+    """Write a FeatureCollection as plain GeoJSON or, if the pool was set up with
+    format='topojson', as quantized and simplified TopoJSON. Also cuts the product's
+    tile pyramid if the pool was set up with tiles, and gzip/brotli copies for the
+    viewer to serve (see precompress.py).
+    """
+    encoding = _state['encoding']
+    if encoding['format'] == 'topojson':
+        data = topology.to_topology(geojson, quantization=encoding['quantization'],
+                                    tolerance=encoding['simplify'])
+        data = json.dumps(data, separators=(',', ':'))
+    else:
+        data = json.dumps(geojson)
+    data = data.encode()
+    precompress.write_file(save_name, data)
+    if encoding['compress']:
+        precompress.write_siblings(save_name, data, encoding['compress'])
+    if encoding['tiles'] is not None:
+        tiles.write_pyramid(geojson, save_name, zooms=encoding['tiles'],
+                            tile_format=encoding['format'])
+
+def _band_top(title, levels):
+    """Upper level of the band a geojsoncontour feature was cut from. Its title is the
+    band's range, "<lower>-<upper> <unit>", with both ends rounded to two decimals.
+    """
+    upper = float(title.split()[0].rsplit('-', 1)[1])
+    return float(min(levels, key=lambda level: abs(level - upper)))
+
+def contourf_task(save_name, data, levels, colors, engine='native'):
+    """Filled contours of one grid, written as GeoJSON.
+
+    Parameters
+    ----------
+    save_name : str
+        Output file
+    data : np.array
+        Grid to contour (MxN)
+    levels : list
+        Contour levels
+    colors : list
+        Fill colors, one per band
+    engine : str
+        'native' (default) contours with isobands.py, 'matplotlib' goes through
+        ax.contourf and geojsoncontour
+
+    Returns
+    -------
+    save_name : str
+    """
+    if engine == 'native':
+        geojson = isobands.isobands_to_geojson(data, _state['lat'], _state['lon'], levels,
+                                               colors, ndigits=2)
+    else:
+        ax = _state['ax']
+        contourf = ax.contourf(_state['lon'], _state['lat'], data, levels, colors=colors)
+        geojson = json.loads(geojsoncontour.contourf_to_geojson(contourf=contourf,
+                                                                ndigits=2))
+        ax.cla()
+        # One feature per non-empty band. The viewer colors each by the band's upper
+        # level.
+        for feature in geojson['features']:
+            feature['properties']['values'] = _band_top(feature['properties']['title'],
+                                                        levels)
+    _write(save_name, geojson)
+    if 'resampler' in _state:
+        png = raster.palette_png(_state['resampler'].resample(data), levels, colors)
+        precompress.write_file(save_name + '.png', png)
+    return save_name
+
+def spaghetti_task(save_names, data, thresholds, titles, colors, engine='native'):
+    """Exceedance contours of every member, merged into one GeoJSON FeatureCollection
+    per threshold. With the native engine each member is contoured once for all
+    thresholds, and members are spread over the pool's spaghetti threads.
+
+    Parameters
+    ----------
+    save_names : list
+        Output files, one per threshold
+    data : np.array
+        Member grids (PxMxN)
+    thresholds : list
+        Exceedance thresholds
+    titles : list
+        Member names, one per member
+    colors : list
+        Fill colors (hex), one per member
+    engine : str
+        'native' (default) or 'matplotlib'. See contourf_task.
+
+    Returns
+    -------
+    save_names : list
+    """
+    if engine == 'native':
+        # The contouring kernels release the GIL, so members run side by side
+        def contour(i):
+            return isobands.exceedance_polygons(data[i], _state['lat'], _state['lon'],
+                                                thresholds, ndigits=2)
+        with ThreadPoolExecutor(_state['encoding']['threads']) as executor:
+            members = list(executor.map(contour, range(data.shape[0])))
+    else:
+        ax = _state['ax']
+        members = []
+        for i in range(data.shape[0]):
+            polygons = []
+            for thresh in thresholds:
+                contourf = ax.contourf(_state['lon'], _state['lat'], data[i],
+                                       [thresh, 999999])
+                tmp = geojsoncontour.contourf_to_geojson(contourf=contourf, ndigits=2)
+                ax.cla()
+                polygons.append([polygon for feature in json.loads(tmp)['features']
+                                 for polygon in feature['geometry']['coordinates']])
+            members.append(polygons)
+
+    for k, save_name in enumerate(save_names):
+        output = dict(features=[], type='FeatureCollection')
+        for i, polygons in enumerate(members):
+            if not polygons[k]: continue
+            output['features'].append({
+                'type': 'Feature',
+                'properties': {'values': i, 'title': titles[i], 'fill': colors[i]},
+                'geometry': {'type': 'MultiPolygon', 'coordinates': polygons[k]}})
+        _write(save_name, output)
+    return list(save_names)
+
+def _run_task(task):
+    func, args = task
+    return func(*args)
+
+class OutputPool():
+    def __init__(self, lat, lon, **kwargs):
+        """Contour and write product files in a pool of worker processes, each with
+        its own figure and axes. Tasks for one forecast hour are submitted as a group
+        and run in the background while the caller moves on to the next hour.
+
+        Parameters
+        ----------
+        lat : np.array
+            Latitudes of the (possibly cropped) grid (MxN)
+        lon : np.array
+            Longitudes of the (possibly cropped) grid (MxN)
+
+        Optional Parameters
+        -------------------
+        workers : int
+            Number of output processes. Default = os.cpu_count(). A value of 1 runs
+            every task in the calling process as soon as it is submitted.
+        format : str
+            'geojson' (default) or 'topojson'
+        quantization : int
+            TopoJSON quantization. Default = 10000
+        simplify : float
+            TopoJSON simplification tolerance in degrees. Default = 0
+        tiles : tuple
+            (lowest, highest) zoom of a z/x/y tile pyramid to cut for every product
+            (see tiles.py). Default = None, no tiles
+        compress : tuple
+            Precompressed copies to write next to every product, any of 'gzip' and
+            'br'. Default = ('gzip',)
+        raster : int
+            Also write a color-mapped PNG (<product>.png) of every filled-contour
+            product, with this many pixels per grid point (see raster.py). Default =
+            None, no images
+        threads : int
+            Threads each spaghetti task contours members on. Default = the cores left
+            per worker, os.cpu_count() // workers, and at least 1
+        max_pending : int
+            Groups allowed in flight. submit() waits for the oldest one beyond this,
+            so a slow output stage holds back ingest instead of queueing every hour's
+            fields in memory. Default = 2
+        """
+        self.workers = kwargs.get('workers', None)
+        if self.workers is None: self.workers = os.cpu_count() or 1
+        threads = kwargs.get('threads', None)
+        if threads is None: threads = max((os.cpu_count() or 1) // self.workers, 1)
+        encoding = {
+            'format': kwargs.get('format', 'geojson'),
+            'quantization': kwargs.get('quantization', 10000),
+            'simplify': kwargs.get('simplify', 0.),
+            'tiles': kwargs.get('tiles', None),
+            'compress': kwargs.get('compress', ('gzip',)),
+            'raster': kwargs.get('raster', None),
+            'threads': threads,
+        }
+        self.max_pending = kwargs.get('max_pending', 2)
+        self.pending = []
+        self.pool = None
+        if self.workers > 1:
+            # Forked for the same reason as the ingest pool: the producer scripts
+            # run at module level.
+            ctx = mp.get_context('fork')
+            self.pool = ctx.Pool(self.workers, initializer=_init_worker,
+                                 initargs=(lat, lon, encoding))
+        else:
+            _init_worker(lat, lon, encoding)
+
+    def submit(self, tag, tasks):
+        """Queue a group of tasks. Blocks while max_pending groups are still running.
+
+        Parameters
+        ----------
+        tag : object
+            Returned by finished() once every task in the group is done
+        tasks : list
+            (function, args) pairs, e.g. (contourf_task, (save_name, data, levs, cols))
+        """
+        if self.pool is not None:
+            # Waiting doesn't collect the group. finished() still returns it.
+            running = [result for _, result in self.pending
+                       if not isinstance(result, list) and not result.ready()]
+            if len(running) >= self.max_pending:
+                running[0].wait()
+            result = self.pool.map_async(_run_task, tasks, chunksize=1)
+        else:
+            result = [_run_task(task) for task in tasks]
+        self.pending.append((tag, result))
+
+    def finished(self, block=False):
+        """Collect the groups that are done, in the order they were submitted. Errors
+        raised in a worker are raised again here.
+
+        Parameters
+        ----------
+        block : bool
+            Wait for every pending group. Default = False
+
+        Returns
+        -------
+        done : list
+            (tag, list of files written) for each finished group
+        """
+        done = []
+        while self.pending:
+            tag, result = self.pending[0]
+            if isinstance(result, list):
+                products = result
+            elif block or result.ready():
+                products = result.get()
+            else:
+                break
+            # Tasks that write several files return a list of them
+            products = [fname for item in products
+                        for fname in (item if isinstance(item, list) else [item])]
+            done.append((tag, products))
+            self.pending.pop(0)
+        return done
+
+    def close(self):
+        """Wait for outstanding work and shut down the worker pool.
+        """
+        done = self.finished(block=True)
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+        return done
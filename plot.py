@@ -1,6 +1,12 @@
+import io
+import os
+import hashlib
+import multiprocessing as mp
 import matplotlib.pyplot as plt
 import matplotlib as mpl
 import pylab
+from matplotlib.collections import LineCollection
+from PIL import Image
 from datetime import datetime, timedelta
 
 import cartopy.feature as cfeature
@@ -8,6 +14,15 @@ import cartopy.crs as ccrs
 import cartopy.io.shapereader as shpreader
 
 from plotconfigs import *
+import boundaries
+
+# County outlines, read from disk once per process
+_counties = []
+
+def county_geometries():
+    if not _counties:
+        _counties.extend(shpreader.Reader(COUNTY_SHAPEFILE).geometries())
+    return _counties
 
 class Plot():
     def __init__(self, **kwargs):
@@ -56,6 +71,11 @@ class Plot():
             Figure plotting object. If None (default), creates one.
         counties : bool
             Whether or not to plot counties. Default = False.
+        domain : str
+            mapinfo.domains key of bounds. Preprocessed boundaries for the domain are
+            used if they have been built (see boundaries.py). Default = None
+        features : bool
+            Whether or not to draw coastlines, states and counties. Default = True.
         """
 
         if not fig: self.make_figure()
@@ -65,21 +85,53 @@ class Plot():
         self.proj = ccrs.PlateCarree(central_longitude=central_longitude)
         self.ax = self.fig.add_axes([0., 0., 1, 1], projection=self.proj)
 
-        # Add geographic information
-        if kwargs.get('counties', False):
-            reader = shpreader.Reader('/Users/leecarlaw/scripts/gefs/shapefiles/countyl010g.shp')
-            counties = list(reader.geometries())
-            COUNTIES = cfeature.ShapelyFeature(counties, ccrs.PlateCarree())
-            self.ax.add_feature(COUNTIES, facecolor='none', edgecolor='darkgrey',
-                                linewidth=0.5)
-        self.ax.coastlines('50m')
-        self.ax.add_feature(cfeature.STATES.with_scale('50m'), linewidth=1)
+        if kwargs.get('features', True):
+            self.add_features(counties=kwargs.get('counties', False),
+                              domain=kwargs.get('domain', None))
 
         # Resize the plotting domain to ensure specific aspect ratio
         self.bounds = self.set_map_extents(min_lon=bounds[0], max_lon=bounds[1],
                                            min_lat=bounds[2], max_lat=bounds[3])
         self.ax.set_extent(self.bounds, crs=ccrs.PlateCarree())
 
+    def add_features(self, counties=False, domain=None):
+        """Add geographic information to the map.
+
+        Parameters
+        ----------
+        counties : bool
+            Whether or not to plot counties. Default = False.
+        domain : str
+            mapinfo.domains key of the map. If boundaries.py has been run, its clipped
+            and simplified lines are drawn instead of the full shapefiles. Default = None
+
+        Returns
+        -------
+        artists : list
+            The feature artists, so they can be removed again
+        """
+        kinds = ['counties'] if counties else []
+        kinds += ['coastlines', 'states']
+        if domain is not None:
+            lines = [boundaries.load(BOUNDARY_DIR, domain, kind) for kind in kinds]
+            if all(kind_lines is not None for kind_lines in lines):
+                artists = []
+                for kind, kind_lines in zip(kinds, lines):
+                    collection = LineCollection(kind_lines, transform=ccrs.PlateCarree(),
+                                                zorder=1.5, **boundaries.STYLES[kind])
+                    artists.append(self.ax.add_collection(collection))
+                return artists
+
+        artists = []
+        if counties:
+            COUNTIES = cfeature.ShapelyFeature(county_geometries(), ccrs.PlateCarree())
+            artists.append(self.ax.add_feature(COUNTIES, facecolor='none',
+                                               edgecolor='darkgrey', linewidth=0.5))
+        artists.append(self.ax.coastlines('50m'))
+        artists.append(self.ax.add_feature(cfeature.STATES.with_scale('50m'),
+                                           linewidth=1))
+        return artists
+
     def set_map_extents(self, min_lon, max_lon, min_lat, max_lat):
         """Alter the requested boundaries to fit a particular aspect ratio. This function
         inherits self.fig_aspect from make_plot().
@@ -138,8 +190,116 @@ class Plot():
 
 
 class PlanView(Plot):
-    def __init__(self):
+    def __init__(self, **kwargs):
+        """Plan view plotting object. The map is drawn without geographic features; those
+        are rendered once per domain into a cached basemap layer, and each product only
+        draws its own contours and text on a transparent layer that is composited with
+        it. Products are drawn on this object's own figure, so several PlanViews can
+        render in separate processes (see RenderPool).
+
+        Optional Parameters
+        -------------------
+        lat : np.array
+            Latitudes of the (possibly cropped) data grid. Default = plotconfigs.lat
+        lon : np.array
+            Longitudes of the (possibly cropped) data grid. Default = plotconfigs.lon
+        bounds : list
+            Map bounds [min_lon, max_lon, min_lat, max_lat]. Default = the data grid
+        domain : str
+            mapinfo.domains key of bounds, for preprocessed boundaries. Default = None
+        counties : bool
+            Whether or not to plot counties. Default = False
+        dpi : int
+            Output resolution. Default = 100
+        cache_dir : str
+            Directory to keep basemap layers in between runs. Default = None, memory only
+        """
         self.dummy = ''
+        self.lat = kwargs.get('lat', lat)
+        self.lon = kwargs.get('lon', lon)
+        bounds = kwargs.get('bounds', [self.lon.min(), self.lon.max(), self.lat.min(),
+                                       self.lat.max()])
+        self.counties = kwargs.get('counties', False)
+        self.domain = kwargs.get('domain', None)
+        self.dpi = kwargs.get('dpi', 100)
+        self.cache_dir = kwargs.get('cache_dir', None)
+        self.make_map(bounds, features=False)
+        self.layout = self.get_layout()
+        self.base = None
+
+    def get_layout(self):
+        """Fixed output geometry shared by the basemap and every product layer: the
+        tight bounding box of the map plus a line of title text, and the colorbar's
+        pixel box within it.
+        """
+        renderer = self.fig.canvas.get_renderer()
+        t1 = self.ax.text(0., 1.007, 'GEFS', transform=self.ax.transAxes, ha='left',
+                          fontsize=12)
+        cax = self.fig.add_axes([0., 0., 1, 0.018])
+        bbox = self.fig.get_tightbbox(renderer).padded(0.1)
+        inches = cax.get_window_extent(renderer).transformed(
+            self.fig.dpi_scale_trans.inverted())
+        t1.remove()
+        cax.remove()
+
+        def to_pixels(x, y):
+            return (int(round((x - bbox.x0) * self.dpi)),
+                    int(round((bbox.y1 - y) * self.dpi)))
+        x0, y1 = to_pixels(inches.x0, inches.y0)
+        x1, y0 = to_pixels(inches.x1, inches.y1)
+        return {'bbox': bbox, 'cbar': (x0, y0, x1, y1)}
+
+    def basemap(self):
+        """Coastlines, states and counties on a transparent layer, rendered once. The
+        colorbar box is cleared so the colorbar stays on top of the map lines.
+
+        Returns
+        -------
+        base : PIL.Image
+            RGBA layer the size of every product image
+        """
+        if self.base is not None: return self.base
+
+        fname = None
+        if self.cache_dir is not None:
+            key = repr((list(self.bounds), self.counties, self.dpi,
+                        self.fig.get_size_inches().tolist()))
+            fname = "%s/basemap_%s.png" % (self.cache_dir,
+                                           hashlib.sha1(key.encode()).hexdigest()[:12])
+            if os.path.exists(fname):
+                self.base = Image.open(fname).convert('RGBA')
+                return self.base
+
+        artists = self.add_features(counties=self.counties, domain=self.domain)
+        self.base = self.render()
+        for artist in artists: artist.remove()
+        self.base.paste((0, 0, 0, 0), self.layout['cbar'])
+
+        if fname is not None:
+            if not os.path.exists(self.cache_dir): os.makedirs(self.cache_dir)
+            tmp_name = "%s.%d.tmp" % (fname, os.getpid())
+            self.base.save(tmp_name, format='PNG')
+            os.replace(tmp_name, fname)
+        return self.base
+
+    def render(self):
+        """Draw the figure as it stands onto a transparent RGBA layer.
+        """
+        buf = io.BytesIO()
+        self.fig.savefig(buf, format='png', dpi=self.dpi, bbox_inches=self.layout['bbox'],
+                         transparent=True)
+        buf.seek(0)
+        return Image.open(buf).convert('RGBA')
+
+    def save(self, save_name):
+        """Composite the product layer between a white background and the basemap, as
+        the features would have been drawn over the fills, and write it to save_name.
+        """
+        layer = self.render()
+        image = Image.new('RGBA', layer.size, (255, 255, 255, 255))
+        image.alpha_composite(layer)
+        image.alpha_composite(self.basemap())
+        image.convert('RGB').save(save_name)
 
     def plot_spag(self, data, time, thresh, run_date, plot_info, prop={}, map_prop={},
                   save_name=None):
@@ -159,20 +319,21 @@ class PlanView(Plot):
         contours = []
         for i in range(n_perts):
             plot_data = np.where(data[i][time] < thresh, 0, data[i][time])
-            c = plt.contour(lon, lat, plot_data, [thresh], linestyles=styles[i],
-                             linewidths=1.75, zorder=99, transform=ccrs.PlateCarree(),
-                             colors=mpl.colors.to_hex(colors[i]))
+            c = self.ax.contour(self.lon, self.lat, plot_data, [thresh],
+                                linestyles=styles[i], linewidths=1.75, zorder=99,
+                                transform=ccrs.PlateCarree(),
+                                colors=mpl.colors.to_hex(colors[i]))
             contours.append(c)
 
         valid_time = run_date + timedelta(hours=int(time*3))
         img_time = "%s GEFS [~27 km] | F%s Valid: %s"%(run_date.strftime("%HZ"),
                                                  str(int(time*3)).zfill(2),
                                                  valid_time.strftime("%HZ %a %b %d %Y"))
-        t1 = pylab.text(1., 1.007, img_time, transform=pylab.gca().transAxes, ha='right',
-                        fontsize=12)
-        t2 = pylab.text(0., 1.007, plot_info, transform=pylab.gca().transAxes, ha='left',
-                        fontsize=12)
-        pylab.savefig(save_name, bbox_inches='tight', dpi=100)
+        t1 = self.ax.text(1., 1.007, img_time, transform=self.ax.transAxes, ha='right',
+                          fontsize=12)
+        t2 = self.ax.text(0., 1.007, plot_info, transform=self.ax.transAxes, ha='left',
+                          fontsize=12)
+        self.save(save_name)
         self.clean_objects(None, contours, t1, t2, None)
 
     def plot_lpmm(self, data, run_date, plot_info, time_str, save_name, prop={},
@@ -192,20 +353,20 @@ class PlanView(Plot):
 
         plot_levs = kwargs.get('plot_levs', qpf_levs)
         plot_cols = kwargs.get('plot_cols', qpf_cols)
-        cf = plt.contourf(lon, lat, data, plot_levs, transform=ccrs.PlateCarree(),
-                          colors=plot_cols)
+        cf = self.ax.contourf(self.lon, self.lat, data, plot_levs,
+                              transform=ccrs.PlateCarree(), colors=plot_cols)
         valid_time = run_date + timedelta(hours=int(time_str))
         img_time = "%s GEFS [~27 km] | F%s Valid: %s"%(run_date.strftime("%HZ"),
                                                  time_str.zfill(2),
                                                  valid_time.strftime("%HZ %a %b %d %Y"))
-        t1 = pylab.text(1., 1.007, img_time, transform=pylab.gca().transAxes, ha='right',
-                        fontsize=12)
-        t2 = pylab.text(0., 1.007, plot_info, transform=pylab.gca().transAxes, ha='left',
-                        fontsize=12)
-
-        cax = plt.axes([0., 0., 1, 0.018])
-        cb = plt.colorbar(cf, cax=cax, orientation='horizontal')
-        pylab.savefig(save_name, bbox_inches='tight', dpi=100)
+        t1 = self.ax.text(1., 1.007, img_time, transform=self.ax.transAxes, ha='right',
+                          fontsize=12)
+        t2 = self.ax.text(0., 1.007, plot_info, transform=self.ax.transAxes, ha='left',
+                          fontsize=12)
+
+        cax = self.fig.add_axes([0., 0., 1, 0.018])
+        cb = self.fig.colorbar(cf, cax=cax, orientation='horizontal')
+        self.save(save_name)
         self.clean_objects(cf, None, t1, t2, cb)
 
     def clean_objects(self, cf, c1, t1, t2, cb):
@@ -219,3 +380,60 @@ class PlanView(Plot):
                 for member in c.collections: member.remove()
         t1.remove()
         t2.remove()
+
+# Worker-local plan view. Set before the render pool forks.
+_view = {}
+
+def _render_task(task):
+    method, args, kwargs = task
+    getattr(_view['p'], method)(*args, **kwargs)
+
+class RenderPool():
+    def __init__(self, view, **kwargs):
+        """Render plan view products in a pool of worker processes. The basemap is
+        drawn before the workers are forked, so they all start with it cached.
+
+        Parameters
+        ----------
+        view : PlanView
+
+        Optional Parameters
+        -------------------
+        workers : int
+            Number of render processes. Default = os.cpu_count(). A value of 1 renders
+            every product in the calling process as soon as it is submitted.
+        """
+        view.basemap()
+        _view['p'] = view
+        self.workers = kwargs.get('workers', None)
+        if self.workers is None: self.workers = os.cpu_count() or 1
+        self.pending = []
+        self.pool = None
+        if self.workers > 1:
+            self.pool = mp.get_context('fork').Pool(self.workers)
+
+    def submit(self, method, *args, **kwargs):
+        """Queue one product, e.g. submit('plot_lpmm', data, run_date, ...). The
+        arguments are those of the PlanView method.
+        """
+        task = (method, args, kwargs)
+        if self.pool is None:
+            _render_task(task)
+            return
+
+        # Every queued product holds a copy of its grid, so don't get too far ahead
+        while self.pending and (self.pending[0].ready() or
+                                len(self.pending) >= 4 * self.workers):
+            self.pending.pop(0).get()
+        self.pending.append(self.pool.apply_async(_render_task, (task,)))
+
+    def close(self):
+        """Wait for outstanding products and shut down the worker pool. Errors raised
+        in a worker are raised again here.
+        """
+        for result in self.pending: result.get()
+        self.pending = []
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
@@ -5,6 +5,9 @@ import numpy as np
 PLOT_DIR = "/Users/leecarlaw/Sites/images/"
 DATA_DIR = '/Users/leecarlaw/model_data/GEFS/'
 JSON_DIR = "/Users/leecarlaw/Sites/json"
+CUBE_DIR = "/Users/leecarlaw/model_data/GEFS/cube"
+COUNTY_SHAPEFILE = "/Users/leecarlaw/scripts/gefs/shapefiles/countyl010g.shp"
+BOUNDARY_DIR = "/Users/leecarlaw/scripts/gefs/boundaries"
 perts = ['p'+str(i).zfill(2) for i in range(1,31)]
 perts += ['c00']
 MM2IN = 0.0393701
@@ -53,3 +56,19 @@ prob_cols = ['#989898','#656565','#4e4e4e','#3e4046','#2a3e83','#1c3dad','#023af
              '#0570fa','#0494f7','#02bcf4','#00e5f0','#70e78c','#b6ea4c','#ffe40b',
              '#fcbb07','#f66003','#f11704','#f87976','#f99d9b','#ffe6e5', '#ffffff']
 prob_levs = np.arange(5,105,5)
+
+gust_cols = ['#bfe6ff','#7dc4f5','#3d9be8','#1f6fd1','#24a84a','#7fcf3a','#f2e22b',
+             '#f9b21f','#f47a16','#e8421a','#c5161d','#96101a','#c238c5','#8f1f9c']
+gust_levs = [20,25,30,35,39,45,50,55,58,64,70,75,80,90]
+
+# Member percentiles of the percentile products. 0 is written as the member minimum.
+percentiles = [0, 10, 25, 50, 75, 90]
+
+# Exceedance thresholds of the probability products, in each product's units
+prob_thresholds = {
+    'qpf_03h': [0.10, 0.25, 0.50, 1.],
+    'qpf_06h': [0.10, 0.25, 0.50, 1.],
+    'qpf_12h': [0.10, 0.25, 0.50, 1.],
+    'snod_total': [1, 3, 6, 9, 12],
+    'gust10m': [30, 35, 39, 50],
+}
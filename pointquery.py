@@ -0,0 +1,121 @@
+import threading
+from collections import OrderedDict
+import numpy as np
+from membercube import MemberCube
+
+class PointLocator():
+    def __init__(self, lat, lon):
+        """Nearest grid point lookup. On a regular latitude/longitude grid the row and
+        column are found by bisection on the grid axes; otherwise by a search over
+        every point.
+
+        Parameters
+        ----------
+        lat : np.array
+            Latitudes (MxN)
+        lon : np.array
+            Longitudes (MxN)
+        """
+        self.lat = np.asarray(lat, dtype=np.float64)
+        self.lon = np.asarray(lon, dtype=np.float64)
+        self.regular = (np.all(self.lat == self.lat[:, :1]) and
+                        np.all(self.lon == self.lon[:1, :]))
+        if self.regular:
+            self.lat_axis = self.lat[:,0]
+            self.lon_axis = self.lon[0,:]
+            self.lat_order = np.argsort(self.lat_axis)
+            self.lon_order = np.argsort(self.lon_axis)
+            self.lat_sorted = self.lat_axis[self.lat_order]
+            self.lon_sorted = self.lon_axis[self.lon_order]
+
+    @staticmethod
+    def _nearest(sorted_axis, order, value):
+        k = int(np.clip(np.searchsorted(sorted_axis, value), 1, sorted_axis.size-1))
+        if value - sorted_axis[k-1] <= sorted_axis[k] - value: k -= 1
+        return int(order[k])
+
+    def locate(self, lat, lon):
+        """Row and column of the grid point nearest to (lat, lon), or None if the point
+        is outside the grid.
+        """
+        if lat < self.lat.min() or lat > self.lat.max() or \
+                lon < self.lon.min() or lon > self.lon.max():
+            return None
+        if self.regular:
+            return (self._nearest(self.lat_sorted, self.lat_order, lat),
+                    self._nearest(self.lon_sorted, self.lon_order, lon))
+        dist = (self.lat - lat)**2 + ((self.lon - lon) * np.cos(np.radians(lat)))**2
+        j, i = np.unravel_index(int(np.argmin(dist)), dist.shape)
+        return int(j), int(i)
+
+class PlumeReader():
+    def __init__(self, cube_dir, **kwargs):
+        """Member plumes at a point, read from the per-cycle member cubes written by
+        create_geojson.py. Opened cubes and their point lookups are kept for reuse.
+
+        Parameters
+        ----------
+        cube_dir : str
+            Directory holding one cube per cycle (CUBE_DIR)
+
+        Optional Parameters
+        -------------------
+        max_cycles : int
+            Number of cycles to keep open. Default = 8
+        """
+        self.cube_dir = cube_dir
+        self.max_cycles = kwargs.get('max_cycles', 8)
+        self.cycles = OrderedDict()
+        self.lock = threading.Lock()
+
+    def _open(self, cycle_str):
+        with self.lock:
+            if cycle_str in self.cycles:
+                self.cycles.move_to_end(cycle_str)
+                return self.cycles[cycle_str]
+        cube = MemberCube("%s/%s" % (self.cube_dir, cycle_str))
+        if cube.meta is None: return None
+        latlon = cube.latlon()
+        entry = (cube, PointLocator(latlon[0], latlon[1]))
+        with self.lock:
+            self.cycles[cycle_str] = entry
+            while len(self.cycles) > self.max_cycles: self.cycles.popitem(last=False)
+        return entry
+
+    def plume(self, cycle_str, var, lat, lon):
+        """Values of every member over the forecast hours at the grid point nearest to
+        (lat, lon).
+
+        Parameters
+        ----------
+        cycle_str : str
+            YYYY-MM-DD/HH
+        var : str
+            Key of membercube.CUBE_VARIABLES
+        lat : float
+        lon : float
+
+        Returns
+        -------
+        plume : dict
+            'grid_lat', 'grid_lon', 'members', 'hours', 'units' and 'values'
+            (member x hour, null where missing). None if the cycle has no cube or the
+            point is outside its grid.
+        """
+        entry = self._open(cycle_str)
+        if entry is None: return None
+        cube, locator = entry
+        if var not in cube.meta['variables']: return None
+        index = locator.locate(lat, lon)
+        if index is None: return None
+        j, i = index
+        hours, values = cube.read_point(var, j, i)
+        return {
+            'grid_lat': float(locator.lat[j,i]),
+            'grid_lon': float(locator.lon[j,i]),
+            'members': cube.meta['members'],
+            'hours': hours,
+            'units': cube.meta['variables'][var]['units'],
+            'values': [[None if np.isnan(v) else round(float(v), 3) for v in row]
+                       for row in values],
+        }
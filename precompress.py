@@ -0,0 +1,106 @@
+"""
+Precompressed siblings of product files (<file>.gz, <file>.br), and the lookup the
+viewer uses to serve them with Content-Encoding instead of compressing on every request.
+"""
+import io
+import os
+import gzip
+
+# brotli is optional. Without it only gzip siblings are written and served.
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+SUFFIXES = {'br': '.br', 'gzip': '.gz'}
+
+def available_encodings(encodings):
+    """The requested encodings that can be written here.
+    """
+    return [enc for enc in encodings if enc in SUFFIXES and (enc != 'br' or brotli)]
+
+def _compress(data, encoding):
+    if encoding == 'br':
+        return brotli.compress(data, quality=11)
+    # mtime=0 keeps the output byte-identical for identical input
+    buf = io.BytesIO()
+    with gzip.GzipFile(fileobj=buf, mode='wb', compresslevel=9, mtime=0) as f:
+        f.write(data)
+    return buf.getvalue()
+
+def write_file(fname, data):
+    """Write bytes to a temporary file and move it into place, so the viewer never
+    serves (or caches) a partially written product.
+    """
+    tmp_name = "%s.%d.tmp" % (fname, os.getpid())
+    with open(tmp_name, 'wb') as f: f.write(data)
+    os.replace(tmp_name, fname)
+
+def write_siblings(fname, data, encodings=('gzip',)):
+    """Write compressed copies of a file next to it.
+
+    Parameters
+    ----------
+    fname : str
+        Product file
+    data : bytes
+        Contents of fname
+    encodings : tuple
+        Any of 'gzip' and 'br'. br is skipped if the brotli module is not installed.
+        Default = ('gzip',)
+
+    Returns
+    -------
+    written : list
+        Sibling files written
+    """
+    written = []
+    for encoding in available_encodings(encodings):
+        sibling = fname + SUFFIXES[encoding]
+        write_file(sibling, _compress(data, encoding))
+        written.append(sibling)
+    return written
+
+def select(fname, accept_encoding):
+    """Pick the file to serve for a request.
+
+    Parameters
+    ----------
+    fname : str
+        Product file
+    accept_encoding : str
+        The request's Accept-Encoding header
+
+    Returns
+    -------
+    path : str
+        File to send. None if fname does not exist.
+    encoding : str
+        Content-Encoding of path, or None for the plain file
+    etag : str
+        Strong ETag of path. Product files never change once written, so the size and
+        modification time identify the bytes.
+    """
+    accepted = []
+    for item in (accept_encoding or '').split(','):
+        parts = [part.strip() for part in item.split(';')]
+        if 'q=0' in parts or 'q=0.0' in parts: continue
+        accepted.append(parts[0])
+    if '*' in accepted: accepted += ['br', 'gzip']
+    try:
+        plain_mtime = os.stat(fname).st_mtime_ns
+    except OSError:
+        return None, None, None
+    for encoding in ('br', 'gzip', None):
+        if encoding is not None and encoding not in accepted: continue
+        path = fname + SUFFIXES[encoding] if encoding else fname
+        try:
+            stat = os.stat(path)
+        except OSError:
+            continue
+        # A sibling older than its product is left over from an earlier run
+        if stat.st_mtime_ns < plain_mtime: continue
+        etag = '"%x-%x%s"' % (stat.st_mtime_ns, stat.st_size,
+                              '-' + encoding if encoding else '')
+        return path, encoding, etag
+    return None, None, None
@@ -0,0 +1,120 @@
+import os
+import json
+import queue
+import threading
+from collections import OrderedDict
+
+class ProductCache():
+    def __init__(self, **kwargs):
+        """Least-recently-used cache of loaded product files for the viewer. Entries are
+        dropped when their file's modification time or size changes, and the oldest
+        entries are evicted once the files held add up to more than max_bytes.
+
+        Optional Parameters
+        -------------------
+        max_bytes : int
+            Upper bound on the summed on-disk size of cached files. Parsed JSON takes
+            a few times more memory than its text. Default = 256 MB
+        """
+        self.max_bytes = kwargs.get('max_bytes', 256 * 1024**2)
+        self.entries = OrderedDict()
+        self.n_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.prefetched = 0
+        self.lock = threading.Lock()
+
+    def get(self, key, fname):
+        """Loaded contents of fname, from the cache if the file is unchanged.
+
+        Parameters
+        ----------
+        key : tuple
+            e.g. (cycle, parm, var_type, threshold, fhr)
+        fname : str
+            Product file
+
+        Returns
+        -------
+        data : dict
+            Shared between callers. Do not modify.
+        """
+        return self._load(key, fname, count=True)
+
+    def prefetch(self, key, fname):
+        """Load fname into the cache unless it is already there and unchanged. Not
+        counted as a hit or miss.
+        """
+        self._load(key, fname, count=False)
+
+    def _load(self, key, fname, count):
+        stat = os.stat(fname)
+        version = (stat.st_mtime_ns, stat.st_size)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[0] == version:
+                if count:
+                    self.entries.move_to_end(key)
+                    self.hits += 1
+                return entry[1]
+            if count: self.misses += 1
+            else: self.prefetched += 1
+
+        with open(fname, 'r') as f: data = json.load(f)
+
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old is not None: self.n_bytes -= old[0][1]
+            if stat.st_size <= self.max_bytes:
+                self.entries[key] = (version, data)
+                self.n_bytes += stat.st_size
+            while self.n_bytes > self.max_bytes:
+                _, (old_version, _) = self.entries.popitem(last=False)
+                self.n_bytes -= old_version[1]
+        return data
+
+    def stats(self):
+        """Hit and miss counts and current size.
+        """
+        with self.lock:
+            return {'hits': self.hits, 'misses': self.misses,
+                    'prefetched': self.prefetched, 'entries': len(self.entries),
+                    'bytes': self.n_bytes}
+
+class Prefetcher():
+    def __init__(self, cache):
+        """Load products into a ProductCache from a background thread, ahead of the
+        requests for them. Each new request replaces whatever is still queued, so the
+        thread always works on the neighbours of what is on screen now.
+
+        Parameters
+        ----------
+        cache : ProductCache
+        """
+        self.cache = cache
+        self.queue = queue.Queue()
+        self.generation = 0
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def request(self, items):
+        """Queue products to load, most wanted first.
+
+        Parameters
+        ----------
+        items : list
+            (key, fname) pairs, as passed to ProductCache.get
+        """
+        generation = self.generation + 1
+        self.generation = generation
+        for item in items: self.queue.put((generation, item))
+
+    def _run(self):
+        while True:
+            generation, (key, fname) = self.queue.get()
+            if generation != self.generation or not os.path.exists(fname): continue
+            try:
+                self.cache.prefetch(key, fname)
+            except (OSError, ValueError):
+                # Still being written. It will be read on demand.
+                pass
@@ -0,0 +1,100 @@
+"""
+Color-mapped raster images of gridded products, for display as an image overlay. Rows
+are spaced evenly in Web Mercator y, so a map can stretch the image linearly between
+its corner coordinates.
+"""
+import io
+import json
+import numpy as np
+from matplotlib.colors import to_rgb
+from PIL import Image
+
+# Web Mercator stops short of the poles. Same limit as tiles.lonlat_to_tile.
+MAX_LAT = 85.0511
+
+def mercator_y(lat):
+    return np.log(np.tan(np.pi / 4. + np.radians(lat) / 2.))
+
+class Resampler():
+    def __init__(self, lat, lon, scale=2):
+        """Bilinear resampling of a regular lat/lon grid onto a Web Mercator image.
+        The weights are computed once and reused for every product on the same grid.
+
+        Parameters
+        ----------
+        lat : np.array
+            Latitudes (MxN). Constant along each row. Rows beyond MAX_LAT are left
+            out of the image.
+        lon : np.array
+            Longitudes (MxN). Constant along each column.
+        scale : int
+            Image pixels per grid point in each direction. Default = 2
+        """
+        lat_axis = np.asarray(lat, dtype=np.float64)[:,0]
+        lon_axis = np.asarray(lon, dtype=np.float64)[0,:]
+        self.bounds = [float(lon_axis.min()), float(lon_axis.max()),
+                       max(float(lat_axis.min()), -MAX_LAT),
+                       min(float(lat_axis.max()), MAX_LAT)]
+        height = lat_axis.size * scale
+        width = lon_axis.size * scale
+
+        # Image rows from north to south, evenly spaced in Mercator y
+        y = np.linspace(mercator_y(self.bounds[3]), mercator_y(self.bounds[2]), height)
+        row_lat = np.degrees(2. * np.arctan(np.exp(y)) - np.pi / 2.)
+        col_lon = np.linspace(self.bounds[0], self.bounds[1], width)
+
+        # Fractional grid index of every image row and column. np.interp needs an
+        # increasing axis, so work in sorted order and map back.
+        self.rows = self._weights(lat_axis, row_lat)
+        self.cols = self._weights(lon_axis, col_lon)
+
+    @staticmethod
+    def _weights(axis, points):
+        order = np.argsort(axis)
+        frac = np.interp(points, axis[order], np.arange(axis.size))
+        k0 = np.clip(np.floor(frac).astype(np.int64), 0, axis.size-2)
+        w = frac - k0
+        return order[k0], order[k0+1], w
+
+    def resample(self, data):
+        """data (MxN) on the image pixels. NaN where any neighbouring point is NaN.
+        """
+        r0, r1, wr = self.rows
+        c0, c1, wc = self.cols
+        wr = wr[:,None]
+        wc = wc[None,:]
+        top = data[r0][:,c0] * (1 - wc) + data[r0][:,c1] * wc
+        bottom = data[r1][:,c0] * (1 - wc) + data[r1][:,c1] * wc
+        return top * (1 - wr) + bottom * wr
+
+def palette_png(values, levels, colors):
+    """Palette-indexed PNG of values colored by band. Band k (levels[k] to
+    levels[k+1]) gets colors[k]; points outside the levels or NaN are transparent.
+
+    Returns
+    -------
+    png : bytes
+    """
+    # Like contourf, nothing is drawn outside the levels. The top band includes its
+    # upper level.
+    index = np.digitize(values, levels)
+    index[values == levels[-1]] = len(levels) - 1
+    index[(index >= len(levels)) | np.isnan(values)] = 0
+    index = index.astype(np.uint8)
+
+    palette = [0, 0, 0]
+    for color in colors:
+        palette += [int(round(255 * c)) for c in to_rgb(color)]
+    image = Image.frombytes('P', (index.shape[1], index.shape[0]), index.tobytes())
+    image.putpalette(palette)
+    buf = io.BytesIO()
+    image.save(buf, format='PNG', optimize=True, transparency=0)
+    return buf.getvalue()
+
+def write_bounds(fname, resampler):
+    """Corner coordinates of the images, as [[south, west], [north, east]] for map
+    image overlays.
+    """
+    bounds = resampler.bounds
+    with open(fname, 'w') as f:
+        json.dump([[bounds[2], bounds[0]], [bounds[3], bounds[1]]], f)
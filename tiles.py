@@ -0,0 +1,229 @@
+"""
+Pre-cut z/x/y tile pyramids of contour products, so the viewer only has to load the
+tiles that cover the map view. Each zoom level is simplified to about one screen pixel,
+with shared-arc simplification from topology.py, then clipped to standard Web Mercator
+tiles.
+
+Layout, for a product file <JSON_DIR>/<cycle>/<product>.fNNN:
+    <JSON_DIR>/<cycle>/tiles/<product>.fNNN/<z>/<x>/<y>.json
+    <JSON_DIR>/<cycle>/tiles/<product>.fNNN/index.json
+"""
+import os
+import json
+import math
+from numba import njit
+import numpy as np
+import topology
+
+TILE_SIZE = 256
+TILE_ZOOMS = (4, 8)
+
+def tile_dir(save_name):
+    """Tile directory of a product file.
+    """
+    path, name = os.path.split(save_name)
+    return "%s/tiles/%s" % (path, name)
+
+def lonlat_to_tile(lon, lat, z):
+    """Tile column and row containing a point at zoom z.
+    """
+    n = 2 ** z
+    lat = min(max(lat, -85.0511), 85.0511)
+    x = int((lon + 180.) / 360. * n)
+    y = int((1. - math.asinh(math.tan(math.radians(lat))) / math.pi) / 2. * n)
+    return min(max(x, 0), n-1), min(max(y, 0), n-1)
+
+def tile_bounds(z, x, y):
+    """[min_lon, max_lon, min_lat, max_lat] of a tile.
+    """
+    n = 2 ** z
+    lon0 = x / n * 360. - 180.
+    lon1 = (x + 1) / n * 360. - 180.
+    lat0 = math.degrees(math.atan(math.sinh(math.pi * (1 - 2 * (y + 1) / n))))
+    lat1 = math.degrees(math.atan(math.sinh(math.pi * (1 - 2 * y / n))))
+    return [lon0, lon1, lat0, lat1]
+
+def tiles_in_bounds(bounds, z):
+    """(x, y) of every tile at zoom z that overlaps bounds.
+
+    Parameters
+    ----------
+    bounds : list
+        [min_lon, max_lon, min_lat, max_lat]
+    z : int
+        Zoom level
+    """
+    x0, y0 = lonlat_to_tile(bounds[0], bounds[3], z)
+    x1, y1 = lonlat_to_tile(bounds[1], bounds[2], z)
+    return [(x, y) for x in range(x0, x1+1) for y in range(y0, y1+1)]
+
+@njit
+def _inside(px, py, side, edge):
+    if side == 0: return px >= edge
+    if side == 1: return px <= edge
+    if side == 2: return py >= edge
+    return py <= edge
+
+@njit
+def _clip_ring(x, y, x0, x1, y0, y1):
+    """Sutherland-Hodgman clip of one ring (no closing point) to a rectangle.
+    """
+    cx, cy = x.copy(), y.copy()
+    edges = (x0, x1, y0, y1)
+    for side in range(4):
+        n = cx.size
+        if n == 0: break
+        edge = edges[side]
+        ox = np.empty(2*n)
+        oy = np.empty(2*n)
+        m = 0
+        for k in range(n):
+            ax, ay, bx, by = cx[k-1], cy[k-1], cx[k], cy[k]
+            a_in = _inside(ax, ay, side, edge)
+            b_in = _inside(bx, by, side, edge)
+            if a_in != b_in:
+                if side < 2:
+                    ox[m] = edge
+                    oy[m] = ay + (edge - ax) / (bx - ax) * (by - ay)
+                else:
+                    ox[m] = ax + (edge - ay) / (by - ay) * (bx - ax)
+                    oy[m] = edge
+                m += 1
+            if b_in:
+                ox[m] = bx
+                oy[m] = by
+                m += 1
+        cx, cy = ox[:m], oy[:m]
+
+    area = 0.
+    for k in range(cx.size):
+        area += cx[k-1]*cy[k] - cx[k]*cy[k-1]
+    return cx, cy, 0.5 * area
+
+def _clip_polygons(polygons, bounds, ndigits):
+    """Clip polygons, each a list of (x, y) ring arrays without the closing point, to a
+    tile. Rings left with no area are dropped, and a polygon goes with its outer ring.
+    """
+    clipped = []
+    for polygon in polygons:
+        rings = []
+        for rx, ry in polygon:
+            rx, ry, area = _clip_ring(rx, ry, bounds[0], bounds[1], bounds[2], bounds[3])
+            if rx.size < 3 or abs(area) < 1e-10:
+                rings.append(None)
+                continue
+            coords = np.round(np.column_stack((rx, ry)), ndigits).tolist()
+            rings.append(coords + [coords[0]])
+        if rings and rings[0] is not None:
+            clipped.append([ring for ring in rings if ring is not None])
+    return clipped
+
+def write_pyramid(geojson, save_name, zooms=TILE_ZOOMS, tile_format='geojson',
+                  quantization=4096):
+    """Cut a contour FeatureCollection into a simplified tile pyramid.
+
+    Parameters
+    ----------
+    geojson : dict
+        GeoJSON FeatureCollection of (Multi)Polygons
+    save_name : str
+        Product file the tiles belong to. Tiles go to tile_dir(save_name).
+    zooms : tuple
+        Lowest and highest zoom level to cut. Default = TILE_ZOOMS
+    tile_format : str
+        'geojson' (default) or 'topojson'
+    quantization : int
+        TopoJSON quantization of each tile. Default = 4096
+
+    Returns
+    -------
+    index : dict
+        Zoom range and, for each zoom, the (x, y) of every tile written
+    """
+    out_dir = tile_dir(save_name)
+    index = {'zooms': list(zooms), 'format': tile_format, 'tiles': {}}
+    for z in range(zooms[0], zooms[1]+1):
+        # About one pixel at this zoom
+        tolerance = 360. / (TILE_SIZE * 2**z)
+        ndigits = max(2, int(math.ceil(-math.log10(tolerance))) + 1)
+        simple = topology.from_topology(topology.to_topology(geojson, tolerance=tolerance),
+                                        ndigits=ndigits)
+
+        tiles = {}
+        for k, feature in enumerate(simple['features']):
+            for polygon in feature['geometry']['coordinates']:
+                rings = []
+                for ring in polygon:
+                    ring = np.array(ring[:-1], dtype=np.float64)
+                    rings.append((ring[:,0].copy(), ring[:,1].copy()))
+                rx, ry = rings[0]
+                bounds = [rx.min(), rx.max(), ry.min(), ry.max()]
+                for xy in tiles_in_bounds(bounds, z):
+                    tiles.setdefault(xy, {}).setdefault(k, []).append(rings)
+
+        written = []
+        for (x, y), pieces in sorted(tiles.items()):
+            bounds = tile_bounds(z, x, y)
+            tile = {'type': 'FeatureCollection', 'features': []}
+            for k, polygons in pieces.items():
+                coords = _clip_polygons(polygons, bounds, ndigits)
+                if not coords: continue
+                tile['features'].append({
+                    'type': 'Feature', 'properties': simple['features'][k]['properties'],
+                    'geometry': {'type': 'MultiPolygon', 'coordinates': coords}})
+            if not tile['features']: continue
+
+            fname = "%s/%d/%d/%d.json" % (out_dir, z, x, y)
+            if not os.path.exists(os.path.dirname(fname)):
+                os.makedirs(os.path.dirname(fname))
+            if tile_format == 'topojson':
+                tile = topology.to_topology(tile, quantization=quantization)
+            tile = json.dumps(tile, separators=(',', ':'))
+            with open(fname, 'w') as f: f.write(tile)
+            written.append([x, y])
+        index['tiles'][str(z)] = written
+
+    # Written last: the viewer only uses a pyramid once its index exists
+    if not os.path.exists(out_dir): os.makedirs(out_dir)
+    tmp_name = "%s/index.json.tmp" % (out_dir)
+    with open(tmp_name, 'w') as f: json.dump(index, f)
+    os.replace(tmp_name, "%s/index.json" % (out_dir))
+    return index
+
+def read_tiles(save_name, bounds, zoom):
+    """Merge the tiles of a product that cover a map view.
+
+    Parameters
+    ----------
+    save_name : str
+        Product file
+    bounds : list
+        [min_lon, max_lon, min_lat, max_lat] of the map view
+    zoom : int
+        Map zoom. Clamped to the zooms in the pyramid.
+
+    Returns
+    -------
+    data : dict
+        A GeoJSON FeatureCollection, or for TopoJSON tiles a {'type': 'TileSet',
+        'tiles': [topology, ...]} to be decoded in the browser. None if the product
+        has no tile pyramid.
+    """
+    out_dir = tile_dir(save_name)
+    try:
+        with open("%s/index.json" % (out_dir), 'r') as f: index = json.load(f)
+    except (OSError, ValueError):
+        return None
+
+    z = int(min(max(round(zoom), index['zooms'][0]), index['zooms'][1]))
+    available = set(tuple(xy) for xy in index['tiles'].get(str(z), []))
+    tiles = []
+    for x, y in tiles_in_bounds(bounds, z):
+        if (x, y) not in available: continue
+        with open("%s/%d/%d/%d.json" % (out_dir, z, x, y), 'r') as f:
+            tiles.append(json.load(f))
+
+    if index['format'] == 'topojson':
+        return {'type': 'TileSet', 'tiles': tiles}
+    features = [feature for tile in tiles for feature in tile['features']]
+    return {'type': 'FeatureCollection', 'features': features, 'tiled': True}
@@ -1,8 +1,48 @@
-from numba import njit
+from numba import njit, prange
 import numpy as np
-from plotconfigs import n_perts, num_y, num_x
 
-def calc_LPMM(data, delta=5):
+def get_domain_window(lat, lon, bounds, halo=0):
+    """Find the smallest index window of the model grid that covers a plotting domain.
+
+    Parameters
+    ----------
+    lat : np.array
+        Latitudes of the model grid (MxN)
+    lon : np.array
+        Longitudes of the model grid (MxN)
+    bounds : list
+        Domain bounds of the form [min_lon, max_lon, min_lat, max_lat]. See mapinfo.py
+    halo : int
+        Number of extra grid points to keep on every side of the domain. Set this to the
+        LPMM radius so that points inside the domain are not affected by the crop.
+        Default=0
+
+    Returns
+    -------
+    window : tuple
+        (row slice, column slice) to apply to MxN grids
+    """
+    inside = (lon >= bounds[0]) & (lon <= bounds[1]) & (lat >= bounds[2]) & \
+             (lat <= bounds[3])
+    rows = np.where(inside.any(axis=1))[0]
+    cols = np.where(inside.any(axis=0))[0]
+    if rows.size == 0 or cols.size == 0:
+        raise ValueError("Domain %s does not overlap the model grid" % (bounds,))
+    num_y, num_x = lat.shape
+    j0 = max(int(rows[0]) - halo, 0)
+    j1 = min(int(rows[-1]) + halo + 1, num_y)
+    i0 = max(int(cols[0]) - halo, 0)
+    i1 = min(int(cols[-1]) + halo + 1, num_x)
+    return (slice(j0, j1), slice(i0, i1))
+
+def _check_finite(data):
+    """The sliding-window kernel matches outgoing values by equality, which NaN never
+    satisfies. Refuse such input rather than corrupt the window.
+    """
+    if np.isnan(data).any():
+        raise ValueError("LPMM input contains NaN. Fill missing member values first.")
+
+def calc_LPMM(data, delta=5, engine='sliding'):
     """Helper function to pass information to the jitted LPMM function. Since numba
     does not allow the axis argument in np.mean(), compute that here and pass out to
     the primary jitted function.
@@ -13,14 +53,129 @@ def calc_LPMM(data, delta=5):
         Ensemble member data at a fixed timed. PxMxN array where P = number of members
     delta : int
         Radius--in grid points--over which to calculate the LPMM. Default=5
+    engine : str
+        LPMM kernel to use. 'sliding' (default) runs the row-parallel sliding-window
+        kernel, 'sort' runs the original per-pixel full sort. Both give identical output.
 
     Returns
     -------
     lpmm : np.array
         Localized Probability-Matched Mean (MxN)
+
+    Raises
+    ------
+    ValueError
+        If data contains NaN, which has no rank in the window (e.g. missing points
+        read back from a MemberCube)
     """
+    if engine not in LPMM_ENGINES:
+        raise ValueError("Unknown LPMM engine '%s'. Options are: %s" %
+                         (engine, ', '.join(LPMM_ENGINES.keys())))
+    _check_finite(data)
     mean = np.mean(data, axis=0)
-    return _LPMM(mean, data, delta)
+    return LPMM_ENGINES[engine](mean, data, delta)
+
+def calc_LPMM_batch(data, delta=5):
+    """Compute the LPMM for many fields and forecast hours in a single call. The
+    ensemble mean and output allocation are done once for the whole stack and the work
+    is split across cores by (field, hour, row).
+
+    Parameters
+    ----------
+    data : np.array
+        Ensemble member data as an FxTxPxMxN array where F = number of fields,
+        T = number of forecast hours and P = number of members
+    delta : int
+        Radius--in grid points--over which to calculate the LPMM. Default=5
+
+    Returns
+    -------
+    lpmm : np.array
+        Localized Probability-Matched Mean (FxTxMxN)
+
+    Raises
+    ------
+    ValueError
+        If data contains NaN
+    """
+    _check_finite(data)
+    mean = np.mean(data, axis=2)
+    return _LPMM_batch(mean, data, delta)
+
+def calc_exceedance_probs(data, thresholds):
+    """Probability of a member value >= each threshold, for many thresholds in one pass.
+    Each member value is ranked against the sorted thresholds once, instead of one pass
+    over all members per threshold.
+
+    Parameters
+    ----------
+    data : np.array
+        Ensemble member data at a fixed time. PxMxN array where P = number of members
+    thresholds : list
+        Thresholds, in the units of data. Need not be sorted.
+
+    Returns
+    -------
+    probs : np.array
+        Probability (%) of exceedance for each threshold (KxMxN, K = len(thresholds)).
+        Missing (NaN) member values count as not exceeding.
+    """
+    thresholds = np.asarray(thresholds, dtype=np.float64)
+    order = np.argsort(thresholds)
+    probs = np.empty((thresholds.size,) + data.shape[1:])
+    probs[order] = _exceedance_probs(data, thresholds[order])
+    return probs
+
+def calc_percentiles(data, percentiles):
+    """Ensemble percentiles, all from a single sort of the member axis rather than one
+    per percentile. Interpolates linearly between members, as np.percentile does.
+
+    With ~30 members one np.sort is cheaper than np.partition on the handful of ranks
+    needed: each extra partition index runs its own selection over every point.
+
+    Parameters
+    ----------
+    data : np.array
+        Ensemble member data at a fixed time. PxMxN array where P = number of members
+    percentiles : list
+        Percentiles between 0 (member minimum) and 100 (member maximum)
+
+    Returns
+    -------
+    values : np.array
+        One MxN grid per percentile (KxMxN, K = len(percentiles))
+    """
+    n_members = data.shape[0]
+    position = np.asarray(percentiles, dtype=np.float64) / 100. * (n_members - 1)
+    lower = np.floor(position).astype(np.int64)
+    upper = np.minimum(lower + 1, n_members - 1)
+    weight = (position - lower)[:,np.newaxis,np.newaxis]
+
+    ranks = np.sort(data, axis=0)
+    return ranks[lower] * (1. - weight) + ranks[upper] * weight
+
+@njit(parallel=True)
+def _exceedance_probs(data, thresholds):
+    """Exceedance probabilities (%) for sorted thresholds. Rows are processed in
+    parallel.
+    """
+    n_members, ny, nx = data.shape
+    n_thresh = thresholds.shape[0]
+    probs = np.zeros((n_thresh, ny, nx))
+    for j in prange(ny):
+        counts = np.zeros(n_thresh+1, dtype=np.int64)
+        for i in range(nx):
+            # counts[r] = number of members at or above exactly r thresholds
+            counts[:] = 0
+            for pert in range(n_members):
+                value = data[pert,j,i]
+                if np.isnan(value): continue
+                counts[np.searchsorted(thresholds, value, side='right')] += 1
+            exceed = 0
+            for k in range(n_thresh-1, -1, -1):
+                exceed += counts[k+1]
+                probs[k,j,i] = 100. * exceed / n_members
+    return probs
 
 @njit
 def _LPMM(mean, data, delta):
@@ -41,6 +196,7 @@ def _LPMM(mean, data, delta):
         Localized Probability-Matched Mean (MxN)
     """
 
+    n_perts, num_y, num_x = data.shape
     n_grids = ((delta * 2) + 1)**2
     lpmm = np.zeros((num_y, num_x))
     for j in range(delta, num_y-delta):
@@ -62,3 +218,148 @@ def _LPMM(mean, data, delta):
             r_ens = n_perts * r_mean
             lpmm[j,i] = member_rank[r_ens]
     return lpmm
+
+@njit(parallel=True)
+def _LPMM_sliding(mean, data, delta):
+    """Compute the Localized Probability-Matched Mean using a sliding window. Rows are
+    processed in parallel. Along each row, a sorted copy of the member values in the
+    window is kept up to date by merging out the column that leaves the window and
+    merging in the column that enters it, so no per-pixel sort is needed. The rank of
+    the ensemble mean is found by counting, and the matching member value is then read
+    straight out of the sorted window.
+
+    Parameters
+    ----------
+    mean : np.array
+        Ensemble mean as an MxN array. Numba doesn't handle axis argument in np.mean().
+    data : np.array
+        Ensemble member data at a fixed time. PxMxN array where P = number of members
+    delta : int
+        Radius--in grid points--over which to calculate the LPMM
+
+    Returns
+    -------
+    lpmm : np.array
+        Localized Probability-Matched Mean (MxN)
+    """
+
+    ny, nx = mean.shape
+    lpmm = np.zeros((ny, nx))
+    for j in prange(delta, ny-delta):
+        _LPMM_row(mean, data, delta, j, lpmm[j])
+    return lpmm
+
+@njit(parallel=True)
+def _LPMM_batch(mean, data, delta):
+    """Compute the Localized Probability-Matched Mean for a stack of fields and times.
+    Work is split by (field, time, row), so a single forecast hour of a few fields
+    still keeps every core busy.
+
+    Parameters
+    ----------
+    mean : np.array
+        Ensemble mean as an FxTxMxN array
+    data : np.array
+        Ensemble member data as an FxTxPxMxN array where P = number of members
+    delta : int
+        Radius--in grid points--over which to calculate the LPMM
+
+    Returns
+    -------
+    lpmm : np.array
+        Localized Probability-Matched Mean (FxTxMxN)
+    """
+
+    n_fields, n_times, ny, nx = mean.shape
+    lpmm = np.zeros((n_fields, n_times, ny, nx))
+    n_rows = max(ny - 2*delta, 0)
+    for item in prange(n_fields*n_times*n_rows):
+        tile = item // n_rows
+        f = tile // n_times
+        t = tile % n_times
+        j = delta + item % n_rows
+        _LPMM_row(mean[f,t], data[f,t], delta, j, lpmm[f,t,j])
+    return lpmm
+
+@njit
+def _LPMM_row(mean, data, delta, j, out):
+    """Sliding-window LPMM along row j. Results are written to out (length N). Rows
+    narrower than the window have no interior points and are left as they are.
+    """
+    n_members, ny, nx = data.shape
+    width = (delta * 2) + 1
+    if nx < width or ny < width: return
+    n_column = width * n_members
+    window = np.empty(width*n_column, dtype=data.dtype)
+    scratch = np.empty(width*n_column, dtype=data.dtype)
+    col_in = np.empty(n_column, dtype=data.dtype)
+    col_out = np.empty(n_column, dtype=data.dtype)
+
+    # Full window for the first interior point in this row
+    knt = 0
+    for ii in range(0, width):
+        for jj in range(j-delta, j+delta+1):
+            for pert in range(n_members):
+                window[knt] = data[pert,jj,ii]
+                knt += 1
+    window.sort()
+
+    for i in range(delta, nx-delta):
+        if i > delta:
+            _get_column(data, j, i-delta-1, delta, col_out)
+            _get_column(data, j, i+delta, delta, col_in)
+            col_out.sort()
+            col_in.sort()
+            _slide_window(window, col_out, col_in, scratch)
+            window, scratch = scratch, window
+
+        # Rank of the mean = number of window means strictly smaller than it
+        r_mean = 0
+        for jj in range(j-delta, j+delta+1):
+            for ii in range(i-delta, i+delta+1):
+                if mean[jj,ii] < mean[j,i]: r_mean += 1
+        out[i] = window[n_members * r_mean]
+
+@njit
+def _get_column(data, j, i, delta, out):
+    """Fill out with all member values in column i between rows j-delta and j+delta.
+    """
+    knt = 0
+    for jj in range(j-delta, j+delta+1):
+        for pert in range(data.shape[0]):
+            out[knt] = data[pert,jj,i]
+            knt += 1
+
+@njit
+def _slide_window(window, col_out, col_in, out):
+    """Merge the sorted window, less the sorted values in col_out, with the sorted
+    values in col_in. The result is written to out and remains sorted.
+    """
+    n_window = window.shape[0]
+    n_column = col_in.shape[0]
+    a = 0
+    r = 0
+    b = 0
+    knt = 0
+    # knt can only overrun if an outgoing value was never found in the window
+    while a < n_window and knt < n_window:
+        if r < n_column and window[a] == col_out[r]:
+            a += 1
+            r += 1
+        elif b < n_column and col_in[b] < window[a]:
+            out[knt] = col_in[b]
+            b += 1
+            knt += 1
+        else:
+            out[knt] = window[a]
+            a += 1
+            knt += 1
+    while b < n_column and knt < n_window:
+        out[knt] = col_in[b]
+        b += 1
+        knt += 1
+
+LPMM_ENGINES = {
+    'sort': _LPMM,
+    'sliding': _LPMM_sliding,
+}
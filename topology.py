@@ -0,0 +1,276 @@
+"""
+Compact TopoJSON encoding of contour FeatureCollections. Coordinates are quantized to
+integers on a regular grid and delta encoded, and boundaries are stored once as arcs
+that neighbouring bands share. Arcs can be simplified before encoding; since a shared
+boundary is one arc, simplifying it cannot open gaps or overlaps between bands.
+"""
+import json
+from numba import njit
+import numpy as np
+
+@njit
+def _simplify(x, y, tol):
+    """Douglas-Peucker keep mask for one arc. End points are always kept. A closed
+    arc is first split at the point farthest from its start so it keeps an area.
+    """
+    n = x.size
+    keep = np.zeros(n, dtype=np.bool_)
+    keep[0] = True
+    keep[n-1] = True
+    if n < 3: return keep
+
+    stack = np.empty((n, 2), dtype=np.int64)
+    top = 0
+    if x[0] == x[n-1] and y[0] == y[n-1]:
+        far, far_dist = 1, -1.
+        for k in range(1, n-1):
+            dist = (x[k]-x[0])**2 + (y[k]-y[0])**2
+            if dist > far_dist: far, far_dist = k, dist
+        keep[far] = True
+        stack[0, 0], stack[0, 1] = 0, far
+        stack[1, 0], stack[1, 1] = far, n-1
+        top = 2
+    else:
+        stack[0, 0], stack[0, 1] = 0, n-1
+        top = 1
+
+    tol2 = tol * tol
+    while top > 0:
+        top -= 1
+        i0, i1 = stack[top, 0], stack[top, 1]
+        if i1 - i0 < 2: continue
+        dx, dy = x[i1] - x[i0], y[i1] - y[i0]
+        seg2 = dx*dx + dy*dy
+        far, far_dist = -1, tol2
+        for k in range(i0+1, i1):
+            px, py = x[k] - x[i0], y[k] - y[i0]
+            if seg2 > 0:
+                cross = px*dy - py*dx
+                dist = cross * cross / seg2
+            else:
+                dist = px*px + py*py
+            if dist > far_dist: far, far_dist = k, dist
+        if far >= 0:
+            keep[far] = True
+            stack[top, 0], stack[top, 1] = i0, far
+            stack[top+1, 0], stack[top+1, 1] = far, i1
+            top += 2
+    return keep
+
+def _rings(collection):
+    """Flatten every ring of every MultiPolygon/Polygon feature.
+
+    Returns
+    -------
+    coords : np.array
+        Ring vertices (Kx2), without the closing point
+    starts : np.array
+        Ring r is coords[starts[r]:starts[r+1]]
+    layout : list
+        For each feature, a list of polygons, each a list of ring numbers
+    """
+    pieces = []
+    layout = []
+    n_rings = 0
+    for feature in collection['features']:
+        geometry = feature.get('geometry') or {}
+        polygons = geometry.get('coordinates', [])
+        if geometry.get('type') == 'Polygon': polygons = [polygons]
+        feature_layout = []
+        for polygon in polygons:
+            polygon_layout = []
+            for ring in polygon:
+                if len(ring) < 4: continue
+                pieces.append(np.asarray(ring[:-1], dtype=np.float64))
+                polygon_layout.append(n_rings)
+                n_rings += 1
+            if polygon_layout: feature_layout.append(polygon_layout)
+        layout.append(feature_layout)
+    if not pieces: return np.empty((0, 2)), np.zeros(1, dtype=np.int64), layout
+    starts = np.concatenate(([0], np.cumsum([len(piece) for piece in pieces])))
+    return np.concatenate(pieces), starts, layout
+
+def to_topology(collection, quantization=10000, tolerance=0., name='contours'):
+    """Encode a GeoJSON FeatureCollection of (Multi)Polygons as TopoJSON.
+
+    Parameters
+    ----------
+    collection : dict
+        GeoJSON FeatureCollection, e.g. from isobands.isobands_to_geojson
+    quantization : int
+        Number of integer steps across the extent of the data in each direction.
+        Default = 10000
+    tolerance : float
+        Douglas-Peucker simplification tolerance, in coordinate units (degrees).
+        Default = 0, no simplification
+    name : str
+        Name of the GeometryCollection in the topology's objects. Default = 'contours'
+
+    Returns
+    -------
+    topology : dict
+    """
+    coords, starts, layout = _rings(collection)
+    topology = {'type': 'Topology', 'objects': {}, 'arcs': []}
+    if coords.shape[0] == 0:
+        topology['transform'] = {'scale': [1, 1], 'translate': [0, 0]}
+        geometries = [{'type': None, 'properties': feature.get('properties', {})}
+                      for feature in collection['features']]
+        topology['objects'][name] = {'type': 'GeometryCollection',
+                                     'geometries': geometries}
+        return topology
+
+    x0, y0 = coords.min(axis=0)
+    x1, y1 = coords.max(axis=0)
+    sx = (x1 - x0) / (quantization - 1) if x1 > x0 else 1.
+    sy = (y1 - y0) / (quantization - 1) if y1 > y0 else 1.
+    topology['transform'] = {'scale': [sx, sy], 'translate': [float(x0), float(y0)]}
+    qx = np.round((coords[:,0] - x0) / sx).astype(np.int64)
+    qy = np.round((coords[:,1] - y0) / sy).astype(np.int64)
+    keys = qx * quantization + qy
+
+    # Drop points that quantize onto the previous point of their ring
+    ring_id = np.repeat(np.arange(starts.size-1), np.diff(starts))
+    index = np.arange(keys.size)
+    prev = index - 1
+    prev[starts[:-1]] = starts[1:] - 1
+    keep = (keys != keys[prev]) | (starts[1:] - starts[:-1] == 1)[ring_id]
+    qx, qy, keys, ring_id = qx[keep], qy[keep], keys[keep], ring_id[keep]
+    counts = np.bincount(ring_id, minlength=starts.size-1)
+    starts = np.concatenate(([0], np.cumsum(counts)))
+
+    # A junction is a point reached from different neighbours in different rings.
+    # Rings are cut into arcs at junctions, so a boundary shared by two bands comes out
+    # as the same arc in both.
+    index = np.arange(keys.size)
+    prev = index - 1
+    nxt = index + 1
+    ring_start = np.repeat(starts[:-1], counts)
+    ring_end = np.repeat(starts[1:], counts)
+    prev[prev < ring_start] = ring_end[prev < ring_start] - 1
+    nxt[nxt >= ring_end] = ring_start[nxt >= ring_end]
+    pair_lo = np.minimum(keys[prev], keys[nxt])
+    pair_hi = np.maximum(keys[prev], keys[nxt])
+    order = np.lexsort((pair_hi, pair_lo, keys))
+    k_s, lo_s, hi_s = keys[order], pair_lo[order], pair_hi[order]
+    new_pair = np.ones(keys.size, dtype=bool)
+    new_pair[1:] = ((k_s[1:] != k_s[:-1]) | (lo_s[1:] != lo_s[:-1]) |
+                    (hi_s[1:] != hi_s[:-1]))
+    pair_keys = k_s[new_pair]
+    multi = np.ones(pair_keys.size, dtype=bool)
+    multi[1:] = pair_keys[1:] != pair_keys[:-1]
+    pair_count = np.diff(np.concatenate((np.flatnonzero(multi), [pair_keys.size])))
+    junction = np.isin(keys, pair_keys[multi][pair_count > 1])
+
+    arcs = []
+    arc_ids = {}
+    ring_arcs = []
+    for r in range(starts.size-1):
+        s0, s1 = starts[r], starts[r+1]
+        if s1 - s0 < 3:
+            ring_arcs.append(None)
+            continue
+        ring_keys = keys[s0:s1]
+        cuts = np.flatnonzero(junction[s0:s1])
+        if cuts.size == 0:
+            first = int(np.argmin(ring_keys))
+            cuts = np.array([first])
+        idx = np.roll(np.arange(s0, s1), -cuts[0])
+        cuts = np.concatenate((cuts - cuts[0], [s1 - s0]))
+        refs = []
+        for c0, c1 in zip(cuts[:-1], cuts[1:]):
+            arc = np.append(idx[c0:c1], idx[c1 % (s1 - s0)])
+            arc_key = tuple(keys[arc].tolist())
+            if arc_key in arc_ids:
+                refs.append(arc_ids[arc_key])
+            elif arc_key[::-1] in arc_ids:
+                refs.append(~arc_ids[arc_key[::-1]])
+            else:
+                arc_ids[arc_key] = len(arcs)
+                refs.append(len(arcs))
+                arcs.append(arc)
+        ring_arcs.append(refs)
+
+    encoded = []
+    lengths = []
+    for arc in arcs:
+        ax, ay = qx[arc], qy[arc]
+        if tolerance > 0:
+            keep = _simplify(ax * sx, ay * sy, tolerance)
+            ax, ay = ax[keep], ay[keep]
+        lengths.append(ax.size)
+        delta = np.column_stack((ax, ay))
+        delta[1:] -= delta[:-1].copy()
+        encoded.append(delta.tolist())
+    topology['arcs'] = encoded
+
+    # Simplification can shrink a small ring to a sliver. Since rings that share an
+    # arc shrink together, dropping them keeps neighbouring bands consistent.
+    def ring_refs(r):
+        refs = ring_arcs[r]
+        if refs is None: return None
+        n_pts = sum(lengths[ref if ref >= 0 else ~ref] - 1 for ref in refs)
+        return refs if n_pts >= 3 else None
+
+    geometries = []
+    for feature, feature_layout in zip(collection['features'], layout):
+        polygons = []
+        for polygon_layout in feature_layout:
+            outer = ring_refs(polygon_layout[0])
+            if outer is None: continue
+            holes = [ring_refs(r) for r in polygon_layout[1:]]
+            polygons.append([outer] + [hole for hole in holes if hole is not None])
+        geometry = {'type': 'MultiPolygon', 'arcs': polygons}
+        if not polygons: geometry = {'type': None}
+        geometry['properties'] = feature.get('properties', {})
+        geometries.append(geometry)
+    topology['objects'][name] = {'type': 'GeometryCollection', 'geometries': geometries}
+    return topology
+
+def write_topology(collection, fname, **kwargs):
+    """Encode a FeatureCollection with to_topology and write it to fname. Keyword
+    arguments are passed to to_topology.
+    """
+    topology = to_topology(collection, **kwargs)
+    with open(fname, 'w') as f: f.write(json.dumps(topology, separators=(',', ':')))
+    return topology
+
+def from_topology(topology, name='contours', ndigits=None):
+    """Decode a topology written by to_topology back into a GeoJSON FeatureCollection.
+
+    Parameters
+    ----------
+    topology : dict
+        TopoJSON topology
+    name : str
+        GeometryCollection to decode. Default = 'contours'
+    ndigits : int
+        Decimal places to round coordinates to. Default = no rounding
+
+    Returns
+    -------
+    geojson : dict
+    """
+    scale = np.asarray(topology['transform']['scale'], dtype=np.float64)
+    translate = np.asarray(topology['transform']['translate'], dtype=np.float64)
+    arcs = []
+    for arc in topology['arcs']:
+        points = np.cumsum(np.asarray(arc, dtype=np.int64).reshape(-1, 2), axis=0)
+        points = points * scale + translate
+        if ndigits is not None: points = np.round(points, ndigits)
+        arcs.append(points.tolist())
+
+    def ring(refs):
+        points = []
+        for ref in refs:
+            arc = arcs[ref] if ref >= 0 else arcs[~ref][::-1]
+            points.extend(arc[1:] if points else arc)
+        return points
+
+    features = []
+    for geometry in topology['objects'][name]['geometries']:
+        if geometry.get('type') is None: continue
+        coords = [[ring(refs) for refs in polygon] for polygon in geometry['arcs']]
+        features.append({'type': 'Feature', 'properties': geometry.get('properties', {}),
+                         'geometry': {'type': 'MultiPolygon', 'coordinates': coords}})
+    return {'type': 'FeatureCollection', 'features': features}